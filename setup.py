@@ -15,19 +15,28 @@ setup(
     url='https://github.com/PragmaticMates/django-whisper',
     packages=[
         'whisper',
+        'whisper.management',
+        'whisper.management.commands',
         'whisper.migrations',
         'whisper.templatetags'
     ],
     include_package_data=True,
-    install_requires=('django', 'channels', 'django-pragmatic>=2.13.0'),
+    python_requires='>=3.8',
+    install_requires=('django>=4.2', 'channels', 'django-pragmatic>=2.13.0'),
     classifiers=[
         'Programming Language :: Python',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'Operating System :: OS Independent',
         'Environment :: Web Environment',
         'Intended Audience :: Developers',
         'Framework :: Django',
+        'Framework :: Django :: 4.2',
         'License :: OSI Approved :: BSD License',
         'Development Status :: 3 - Alpha'
     ],
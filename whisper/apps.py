@@ -15,12 +15,25 @@ class ChatConfig(AppConfig):
     name = 'whisper'
     verbose_name = _('Chat')
 
+    def ready(self):
+        from whisper import signals  # noqa: F401
+        from whisper.registry import registry
+        registry.autodiscover()
+
+        from whisper import settings as whisper_settings
+
+        if whisper_settings.INSTRUMENTATION:
+            from django.db.backends.signals import connection_created
+            from whisper.instrumentation import aggregator, event_measured, install_query_recorder
+            connection_created.connect(install_query_recorder)
+            event_measured.connect(aggregator.receive)
+
     def schedule_jobs(self):
         try:
             import django_rq
             scheduler = django_rq.get_scheduler('cron')
 
-            # Cron task to check status of companies
+            # Cron task planning notifications about unread messages, notifications are sent by jobs in WHISPER_NOTIFY_QUEUE
             scheduler.cron(
                 "*/5 * * * *",  # Run every 5 minutes
                 func=notify_about_unread_messages,
@@ -0,0 +1,177 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import router
+
+from whisper import settings
+
+
+class LocalLRUCache:
+    """
+    Small thread safe in-process LRU cache with expiring entries
+    """
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                return default
+
+            if expires < time.monotonic():
+                del self.data[key]
+                return default
+
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.timeout, value)
+            self.data.move_to_end(key)
+
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+
+class RoomMembershipCache:
+    """
+    Member ids of rooms stored in Django cache with in-process LRU in front of it
+    """
+    def __init__(self):
+        self.local = LocalLRUCache(settings.LOCAL_CACHE_SIZE, settings.LOCAL_CACHE_TIMEOUT)
+
+    @staticmethod
+    def get_key(room_pk):
+        return f'whisper:room-members:{room_pk}'
+
+    def get_member_ids(self, room_pk):
+        key = self.get_key(room_pk)
+        member_ids = self.local.get(key)
+
+        if member_ids is None:
+            member_ids = cache.get(key)
+
+            if member_ids is None:
+                from whisper.models import RoomUser
+                member_ids = list(RoomUser.objects.filter(room_id=room_pk).values_list('user_id', flat=True))
+                cache.set(key, member_ids, settings.MEMBERSHIP_CACHE_TIMEOUT)
+
+            self.local.set(key, member_ids)
+
+        return member_ids
+
+    def get_group_names(self, room_pk):
+        return [f'unread-chat-messages-{user_pk}' for user_pk in self.get_member_ids(room_pk)]
+
+    def invalidate(self, room_pk):
+        key = self.get_key(room_pk)
+        self.local.delete(key)
+        cache.delete(key)
+
+
+class RoomCache:
+    """
+    Room fields needed by callers (id, slug, name) by slug stored in Django cache with in-process LRU in front of it.
+    Slugs without room are cached as well for shorter time.
+    Returned rooms are new instances with other fields deferred, so fresh modified is loaded only when it's read.
+    """
+    MISSING = 'missing'
+    FIELDS = ('id', 'slug', 'name')
+
+    def __init__(self):
+        self.local = LocalLRUCache(settings.LOCAL_CACHE_SIZE, settings.LOCAL_CACHE_TIMEOUT)
+
+    @staticmethod
+    def get_key(slug):
+        return f'whisper:room:{slug}'
+
+    def get_values(self, slug):
+        key = self.get_key(slug)
+        values = self.local.get(key)
+
+        if values is None:
+            values = cache.get(key)
+
+            if values is None:
+                from whisper.models import Room
+
+                values = Room.objects.filter(slug=slug).values(*self.FIELDS).first()
+
+                if values is not None:
+                    cache.set(key, values, settings.ROOM_CACHE_TIMEOUT)
+                else:
+                    values = self.MISSING
+                    cache.set(key, values, settings.ROOM_NEGATIVE_CACHE_TIMEOUT)
+
+            self.local.set(key, values)
+
+        return None if values == self.MISSING else values
+
+    def get_room(self, slug):
+        """
+        New room instance with cached fields or None
+        """
+        from whisper.models import Room
+
+        values = self.get_values(slug)
+
+        if values is None:
+            return None
+
+        return Room.from_db(router.db_for_read(Room), list(self.FIELDS), [values[field] for field in self.FIELDS])
+
+    def invalidate(self, slug):
+        key = self.get_key(slug)
+        self.local.delete(key)
+        cache.delete(key)
+
+
+class RecentRoomsCache:
+    """
+    Recent rooms of users (with unread messages counts) stored in Django cache,
+    invalidated when rooms of user get new messages or user reads them
+    """
+    @staticmethod
+    def get_key(user_pk):
+        return f'whisper:recent-rooms:{user_pk}'
+
+    @staticmethod
+    def get_queryset(user):
+        from whisper.models import Room
+        return Room.objects.recent(user).not_empty()
+
+    def get_rooms(self, user):
+        if not user.is_authenticated:
+            return []
+
+        key = self.get_key(user.pk)
+        rooms = cache.get(key)
+
+        if rooms is None:
+            rooms = list(self.get_queryset(user))
+            cache.set(key, rooms, settings.RECENT_ROOMS_CACHE_TIMEOUT)
+
+        return rooms
+
+    def invalidate(self, user_pks):
+        cache.delete_many([self.get_key(user_pk) for user_pk in user_pks])
+
+    def invalidate_room(self, room_pk):
+        self.invalidate(membership_cache.get_member_ids(room_pk))
+
+
+membership_cache = RoomMembershipCache()
+room_cache = RoomCache()
+recent_rooms_cache = RecentRoomsCache()
@@ -5,28 +5,36 @@ from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
-from django.template import loader
+from django.db.models import Count
 from django.template.defaultfilters import date
 from django.templatetags.tz import localtime
+from django.utils.dateparse import parse_datetime
 from django.utils.timezone import now
 
-from pragmatic.templatetags.pragmatic_tags import url_anchor
 from whisper import settings
+from whisper.cache import membership_cache, room_cache, recent_rooms_cache
+from whisper.directory import user_directory
+from whisper.forms import RoomAddMemberForm
 from whisper.helpers import ChatMessageHelper
+from whisper.indicators import TypingIndicator
+from whisper.instrumentation import InstrumentedConsumerMixin
 from whisper.models import Room, Message, RoomUser
 from whisper.views import RoomAddMemberView
+from whisper.writers import message_writer
 
 
-class ChatConsumer(AsyncJsonWebsocketConsumer):
+class ChatConsumer(InstrumentedConsumerMixin, AsyncJsonWebsocketConsumer):
+    receive_events = ('leave_room', 'user_typing', 'room_members', 'search_members', 'load_older', 'remove_member', 'add_members')
+    default_receive_event = 'chat_message'
 
     async def websocket_connect(self, message):
         room_slug = self.scope['url_route']['kwargs']['room_slug']
 
         # init variables
         self.user = self.scope['user']
+        self.typing_indicator = TypingIndicator(self)
         self.room = await self.get_room(room_slug)
         self.groups.append(self.room.group_name)
-        type = message['type']
 
         await super().websocket_connect(message)
 
@@ -48,68 +56,118 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 await ChatMessageHelper.send_message(self.room, json.dumps({'USER_JOINED': {'username': str(self.user)}}))
 
         # update last read flag of current room user
-        await self.update_room_user(self.room, self.user)
+        await self.mark_room_read()
 
         # send room properties
-        self.user_count = await ChatMessageHelper.get_user_count(self.room)
+        modified, self.user_count = await self.get_room_properties()
         await self.send_json(content={
             'type': 'room_properties',
             'room_name': self.room.name,
             'room_id': self.room.pk,
             'room_slug': room_slug,
-            'room_modified': date(localtime(self.room.modified), settings.DATETIME_FORMAT),
+            'room_modified': date(localtime(modified), settings.DATETIME_FORMAT),
             'user_count': self.user_count,
             'is_user_to_user': self.room.is_user_to_user_room
         })
 
-        # init room with previous messages
-        for message in await self.get_room_messages():
-            await self.send_json(content={
-                'type': type,
-                'message': url_anchor(str(message)),
-                'timestamp': date(localtime(message.created), settings.DATETIME_FORMAT),
-                'username': str(message.user) if message.user is not None else None,
-            })
+        # init room with latest messages
+        await self.send_history()
 
-        await self.channel_layer.group_send(
-            f'unread-chat-messages-{self.user.pk}', {
-                'type': 'chat_message',
-            }
-        )
+    async def disconnect(self, code):
+        if hasattr(self, 'typing_indicator'):
+            self.typing_indicator.stop()
+
+            if self.user.is_authenticated:
+                await self.typing_indicator.typing(False)
 
     @database_sync_to_async
     def get_room(self, slug):
+        room = room_cache.get_room(slug)
+
+        if room is None:
+            room = Room.objects.create_from_slug(slug, self.user)
+
+        return room
+
+    @database_sync_to_async
+    def get_room_properties(self):
+        # modified timestamp is not cached with room, it's loaded fresh together with count of members
+        return Room.objects.filter(pk=self.room.pk).annotate(user_count=Count('users')).values_list('modified', 'user_count').get()
+
+    @staticmethod
+    def parse_history_cursor(before):
+        """
+        Returns (created, id) cursor of oldest loaded message sent by client or None if it is not valid
+        """
+        if not isinstance(before, dict) or not isinstance(before.get('created', None), str):
+            return None
+
         try:
-            return Room.objects.get(slug=slug)
-        except ObjectDoesNotExist:
-            return Room.objects.create_from_slug(slug, self.user)
+            created = parse_datetime(before['created'])
+            message_id = int(before.get('id', None))
+        except (TypeError, ValueError):
+            return None
+
+        if created is None or isinstance(before['id'], bool) or not 0 < message_id < 2 ** 63:
+            return None
+
+        return created, message_id
 
     @database_sync_to_async
-    def get_room_messages(self):
-        return self.room.message_set.all()
+    def get_history(self, before=None):
+        # fetch one extra message to find out if there are older pages
+        messages = list(Message.objects.history(self.room, before, settings.HISTORY_PAGE_SIZE + 1).select_related('user'))
+        has_more = len(messages) > settings.HISTORY_PAGE_SIZE
+
+        return {
+            'type': 'history',
+            'messages': [ChatMessageHelper.serialize_message(message) for message in reversed(messages[:settings.HISTORY_PAGE_SIZE])],
+            'has_more': has_more,
+            'older': before is not None,
+        }
+
+    async def send_history(self, before=None):
+        await self.send_json(content=await self.get_history(before))
 
     @database_sync_to_async
     def remove_user_from_room(self, user_id):
-        return RoomUser.objects.filter(user__pk=user_id, room=self.room).delete()
+        deleted = RoomUser.objects.filter(user__pk=user_id, room=self.room).delete()
+        membership_cache.invalidate(self.room.pk)
+        return deleted
 
     @database_sync_to_async
     def get_user(self, user_id):
         return RoomUser.get_user(self.room, user_id)
 
     @database_sync_to_async
-    def get_room_users(self):
-        return RoomUser.get_users(self.room)
+    def search_members(self, query, after=None):
+        users, next_cursor = user_directory.search(RoomUser.get_possible_users_to_add(self.room.pk), query, after)
+
+        return {
+            'type': 'member_candidates',
+            'query': query,
+            'append': after is not None,
+            'next': next_cursor,
+            'users': [{'id': user.pk, 'name': str(user)} for user in users],
+        }
 
     @database_sync_to_async
-    def add_room_users(self, user_pks):
-        users = []
+    def get_room_members(self):
+        # rendering is kept off the event loop
+        form_class = RoomAddMemberView.load_form_class()
 
-        user_objects = get_user_model().objects.filter(pk__in=user_pks)
+        # custom forms don't have to support autocomplete widget
+        form_kwargs = {'autocomplete': True} if issubclass(form_class, RoomAddMemberForm) else {}
 
-        for user in user_objects:
-            users.append(self.room.add_user(user))
+        return {
+            'type': 'room_members',
+            'form': str(form_class(room_pk=self.room.pk, **form_kwargs).as_p()),
+            'members': user_directory.get_members(self.room, self.user),
+        }
 
-        return users
+    @database_sync_to_async
+    def add_room_users(self, user_pks):
+        return self.room.add_users(get_user_model().objects.filter(pk__in=user_pks))
 
     @database_sync_to_async
     def get_room_user(self):
@@ -120,7 +178,22 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
     @database_sync_to_async
     def update_room_user(self, room, user):
-        RoomUser.objects.update_or_create(room=room, user=user, defaults={'last_read': now()})
+        RoomUser.objects.update_or_create(room=room, user=user, defaults={'last_read': now(), 'unread_count': 0})
+        recent_rooms_cache.invalidate([user.pk])
+
+    async def mark_room_read(self):
+        await self.update_room_user(self.room, self.user)
+
+        await self.channel_layer.group_send(
+            f'unread-chat-messages-{self.user.pk}', {
+                'type': 'room_read',
+                'room_id': self.room.pk,
+            }
+        )
+
+    @database_sync_to_async
+    def get_unread_sequence(self):
+        return ChatMessageHelper.next_unread_sequence(self.room, pending_sender=self.user)
 
     @database_sync_to_async
     def get_or_create_group_room(self, user_ids):
@@ -138,19 +211,23 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 await ChatMessageHelper.send_message(self.room, json.dumps(dict_message))
 
             elif json_type == 'user_typing':
-
-                for group_name in self.groups:
-                    await self.channel_layer.group_send(
-                        group_name, {
-                            'type': 'user_typing',
-                            'username': str(self.user),
-                            'text': ChatMessageHelper.message_from_type('USER_TYPING', username=str(self.user))
-                        }
-                    )
+                await self.typing_indicator.typing(content.get('typing', True))
 
             elif json_type == 'room_members':
                 await self.send_room_members()
 
+            elif json_type == 'search_members':
+                # malformed cursors are ignored (first page is sent)
+                after = user_directory.parse_cursor(content.get('after', None))
+                await self.send_json(content=await self.search_members(content.get('query', ''), after))
+
+            elif json_type == 'load_older':
+                before = self.parse_history_cursor(content.get('before', None))
+
+                # malformed cursors are ignored
+                if before is not None:
+                    await self.send_history(before=before)
+
             elif json_type == 'remove_member':
                 user_ids = content.get('user_id', None)
                 user = await self.get_user(user_ids)
@@ -176,60 +253,50 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                             )
                     else:
                         users = await self.add_room_users(user_ids)
-
-                        for user in users:
-                            dict_message = {'USER_JOINED': {'username': str(user.user)}}
-                            await ChatMessageHelper.send_message(self.room, json.dumps(dict_message))
-
+                        await ChatMessageHelper.send_membership_message(self.room, users)
                         await self.send_room_members()
 
             else:
                 text = content['message']
 
                 # update last read flag of current room user (create if not exists)
-                await self.update_room_user(self.room, self.user)
-
-                message = Message.objects.create(
-                    room=self.room,
-                    user=self.user,
-                    text=text
+                await self.mark_room_read()
+
+                await self.typing_indicator.typing(False)
+
+                # sequence is taken before message is queued, so resync of unread consumers counts it until it's stored
+                sequence = await self.get_unread_sequence()
+
+                # message is stored in background (together with unread counters and room modified timestamp)
+                message, stored = message_writer.write(self.room, self.user, text, sequence)
+
+                if stored is not None:
+                    try:
+                        await stored
+                    except Exception:
+                        # message was not stored (logged by writer), sender is notified and nothing is broadcasted
+                        await self.send_json(content={'type': 'message_failed', 'uuid': str(message.uuid)})
+                        return
+
+                # Send message to room group and unread consumers of room members
+                await ChatMessageHelper.broadcast_message(
+                    self.channel_layer, self.room, {
+                        'type': 'chat_message',
+                        'uuid': str(message.uuid),
+                        'message': message.rendered_text,
+                        'username': str(self.user),
+                        'timestamp': date(localtime(message.created), settings.DATETIME_FORMAT)
+                    }, {
+                        'type': 'chat_message',
+                        'room_id': self.room.pk,
+                        'sender_id': self.user.pk,
+                        'delta': 1,
+                        'seq': sequence,
+                    }
                 )
 
-                # update modified timestamp
-                self.room.save()
-
-                # Send message to room group
-                for group_name in self.groups:
-                    await self.channel_layer.group_send(
-                        group_name, {
-                            'type': 'chat_message',
-                            'message': url_anchor(text),
-                            'username': str(self.user),
-                            'timestamp': date(localtime(message.created), settings.DATETIME_FORMAT)
-                        }
-                    )
-
-                for group_name in self.room.user_groups:
-                    await self.channel_layer.group_send(
-                        group_name, {
-                            'type': 'chat_message',
-                        }
-                    )
-
     async def send_room_members(self):
-        users = await self.get_room_users()
-        form_class = RoomAddMemberView.load_form_class()
-        await self.send_json(content={
-            'type': 'room_members',
-            'form': str(form_class(room_pk=self.room.pk).as_p()),
-            'members': [{
-                'id': user.id,
-                'name': str(user),
-                'html': loader.get_template('whisper/member.html').render(
-                    {'user': user, 'scope_user': self.user, 'is_user_to_user': self.room.is_user_to_user_room}
-                )
-            } for user in users],
-        })
+        await self.send_json(content=await self.get_room_members())
 
     # Receive message from room group
     async def chat_message(self, event):
@@ -238,8 +305,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
     # Receive user_typing from room group
     async def user_typing(self, event):
-        # Send user_typing to WebSocket
-        await self.send_json(content=event)
+        # merged state of typing users is sent to WebSocket periodically
+        self.typing_indicator.receive(event)
 
     # Receive room_properties from room group
     async def room_properties(self, event):
@@ -252,7 +319,12 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         await self.send_json(content=event)
 
 
-class UnreadChatMessagesConsumer(AsyncJsonWebsocketConsumer):
+class UnreadChatMessagesConsumer(InstrumentedConsumerMixin, AsyncJsonWebsocketConsumer):
+    receive_events = ('search_users',)
+
+    # events after skipped sequence before it's considered lost
+    REORDER_WINDOW = 20
+
     async def websocket_connect(self, message):
         self.user = self.scope['user']
 
@@ -262,23 +334,148 @@ class UnreadChatMessagesConsumer(AsyncJsonWebsocketConsumer):
 
             await super().websocket_connect(message)
 
-            unread_messages = await self.get_unread_messages(self.scope['user'])
-
             # init current socket
-            await self.send_json(content=unread_messages)
+            await self.sync_unread_messages()
+
+            # subscribe to unread events of all rooms of user
+            for room_id in self.unread_rooms.keys():
+                await self.join_room_group(room_id)
+
+    async def receive_json(self, content):
+        if content.get('type', None) == 'search_users':
+            # malformed cursors are ignored (first page is sent)
+            after = user_directory.parse_cursor(content.get('after', None))
+            await self.send_json(content=await self.search_users(content.get('query', ''), after))
 
     @database_sync_to_async
-    def get_unread_messages(self, user):
-        unread_messages = Message.objects.unread_by_user(user).count()
-        unread_rooms = Room.objects.with_unread_messages(user).values('pk', 'unread_messages')
+    def search_users(self, query, after=None):
+        queryset = user_directory.get_users().exclude(pk=self.user.pk)
+        users, next_cursor = user_directory.search(queryset, query, after)
+        entries = user_directory.render_entries(users)
 
         return {
-            'unread_messages': unread_messages,
-            'unread_rooms': list(unread_rooms)
+            'type': 'users',
+            'query': query,
+            'append': after is not None,
+            'next': next_cursor,
+            'users': [{
+                'id': user.pk,
+                'html': entries[user.pk],
+                'room_slug': 'users-{}-{}'.format(*sorted([user.pk, self.user.pk])),
+            } for user in users],
         }
 
+    @database_sync_to_async
+    def get_unread_state(self, user):
+        unread_rooms = dict(RoomUser.objects.filter(user=user).values_list('room_id', 'unread_count'))
+        sequences = ChatMessageHelper.get_unread_sequences(unread_rooms.keys())
+
+        # messages in write-behind buffers are counted by sequences already, but not by stored counters
+        for room_id, count in ChatMessageHelper.count_pending_unread(sequences, user.pk).items():
+            unread_rooms[room_id] += count
+
+        return unread_rooms, sequences
+
+    async def sync_unread_messages(self):
+        self.unread_rooms, self.sequences = await self.get_unread_state(self.user)
+        self.missing_sequences = {}
+        await self.send_unread_messages()
+
+    async def send_unread_messages(self):
+        await self.send_json(content={
+            'unread_messages': sum(self.unread_rooms.values()),
+            'unread_rooms': [{'pk': pk, 'unread_messages': count} for pk, count in self.unread_rooms.items() if count > 0]
+        })
+
     # Receive message from room group
     async def chat_message(self, event):
-        # Send message to WebSocket
-        unread_messages = await self.get_unread_messages(self.scope['user'])
-        await self.send_json(content=unread_messages)
+        room_id = event.get('room_id', None)
+        sequence = event.get('seq', None)
+
+        if room_id is None:
+            await self.sync_unread_messages()
+            return
+
+        if sequence is not None:
+            counted = self.check_sequence(room_id, sequence)
+
+            if counted is None:
+                # some events were lost (or the sequence was reset), counts are not reliable anymore
+                await self.sync_unread_messages()
+                return
+
+            if not counted:
+                return
+
+        if event.get('sender_id', None) == self.user.pk:
+            return
+
+        self.unread_rooms[room_id] = self.unread_rooms.get(room_id, 0) + event.get('delta', 1)
+        await self.send_unread_messages()
+
+    def check_sequence(self, room_id, sequence):
+        """
+        Records sequence of unread event, returns True if event should be counted, False if it is counted already
+        (by resync or as duplicate) and None if events were lost
+
+        Sequences are taken before messages are stored and broadcast, so events of different senders (and processes)
+        arrive out of order. Skipped sequence is considered lost only if it doesn't arrive within REORDER_WINDOW events.
+        """
+        last_sequence = self.sequences.get(room_id, None)
+        missing = self.missing_sequences.setdefault(room_id, set())
+
+        if last_sequence is None:
+            self.sequences[room_id] = sequence
+            return True
+
+        if sequence <= last_sequence - self.REORDER_WINDOW:
+            # sequence was reset (e.g. evicted from cache)
+            return None
+
+        if sequence <= last_sequence:
+            # late event, counted only if it was skipped (resync counts events up to its sequence)
+            if sequence in missing:
+                missing.discard(sequence)
+                return True
+
+            return False
+
+        missing.update(range(last_sequence + 1, sequence))
+        self.sequences[room_id] = sequence
+
+        if missing and min(missing) <= sequence - self.REORDER_WINDOW:
+            return None
+
+        return True
+
+    async def join_room_group(self, room_id):
+        group_name = f'unread-room-{room_id}'
+
+        if group_name not in self.groups:
+            self.groups.append(group_name)
+            await self.channel_layer.group_add(group_name, self.channel_name)
+
+    async def leave_room_group(self, room_id):
+        group_name = f'unread-room-{room_id}'
+
+        if group_name in self.groups:
+            self.groups.remove(group_name)
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+
+    # Receive room_joined from user group
+    async def room_joined(self, event):
+        await self.join_room_group(event['room_id'])
+        await self.sync_unread_messages()
+
+    # Receive room_left from user group
+    async def room_left(self, event):
+        await self.leave_room_group(event['room_id'])
+        self.unread_rooms.pop(event['room_id'], None)
+        self.sequences.pop(event['room_id'], None)
+        self.missing_sequences.pop(event['room_id'], None)
+        await self.send_unread_messages()
+
+    # Receive room_read from user group
+    async def room_read(self, event):
+        self.unread_rooms[event['room_id']] = 0
+        await self.send_unread_messages()
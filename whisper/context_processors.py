@@ -1,11 +1,12 @@
+from django.utils.functional import SimpleLazyObject
+
 from whisper import settings
-from whisper.models import Room
+from whisper.cache import recent_rooms_cache
 
 
 def chat(request):
-    # TODO: cache to save DB requests or use template tags in chat.html template instead
-
+    # recent rooms are loaded (from cache) only if template uses them
     return {
         'chat_users': settings.CHAT_USERS,
-        'recent_rooms': Room.objects.recent(request.user).not_empty()
+        'recent_rooms': SimpleLazyObject(lambda: recent_rooms_cache.get_rooms(request.user))
     }
@@ -1,9 +1,12 @@
-from datetime import timedelta
+import time
+from collections import defaultdict
+from itertools import groupby
+from operator import attrgetter
 
 from django.conf import settings
-from django.contrib.auth import get_user_model
 from django.contrib.sites.shortcuts import get_current_site
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template import loader, TemplateDoesNotExist
 from django.utils import translation
 from django.utils.timezone import now
@@ -17,44 +20,142 @@ except ImportError:
 
 def notify_about_unread_messages():
     """
-    - iterate every user and check their rooms with unread and not notified messages
+    - plan notifications: split users due for notification into chunks and enqueue a job for every chunk
     """
-    from whisper.models import Room, RoomUser
+    from whisper import settings as whisper_settings
 
+    user_ids = get_due_user_ids().iterator(chunk_size=whisper_settings.NOTIFY_CHUNK_SIZE)
+
+    chunks = 0
+    chunk = []
+
+    for user_id in user_ids:
+        chunk.append(user_id)
+
+        if len(chunk) >= whisper_settings.NOTIFY_USERS_PER_JOB:
+            enqueue_notifications(chunk)
+            chunks += 1
+            chunk = []
+
+    if chunk:
+        enqueue_notifications(chunk)
+        chunks += 1
+
+    return chunks
+
+
+def get_due_user_ids():
+    from whisper.models import RoomUser
+
+    return RoomUser.objects.due_for_notification()\
+        .order_by('user_id')\
+        .values_list('user_id', flat=True)\
+        .distinct()
+
+
+def get_due_members(user_ids):
+    from whisper.models import RoomUser
+
+    return RoomUser.objects.due_for_notification()\
+        .filter(user_id__in=user_ids)\
+        .select_related('user', 'room')\
+        .order_by('user_id', 'room_id')
+
+
+def enqueue_notifications(user_ids):
+    from whisper import settings as whisper_settings
+
+    try:
+        import django_rq
+        django_rq.get_queue(whisper_settings.NOTIFY_QUEUE).enqueue(notify_users, user_ids)
+    except ImportError:
+        # django RQ couldn't be imported, notify synchronously
+        notify_users(user_ids)
+
+
+def notify_users(user_ids):
+    """
+    - notify chunk of users about all their rooms with unread messages
+    - emails are rendered and sent in batches over one connection (WHISPER_NOTIFY_EMAIL_BATCH_SIZE)
+    - progress is recorded after every successfully sent batch (last_notified), failed job can be retried without sending whole chunk again
+    - users locked by another worker (duplicate chunk) are skipped
+    """
+    from whisper import settings as whisper_settings
+
+    # due members are selected again, users notified by previous (failed) run are not due anymore
+    members = get_due_members(user_ids).iterator(chunk_size=whisper_settings.NOTIFY_CHUNK_SIZE)
+
+    activate_language()
+    templates = get_notification_templates()
+    rate_limiter = RateLimiter(whisper_settings.NOTIFY_RATE_LIMIT)
     notified_users = 0
+    batch = []
+
+    # send errors are raised, job fails before checkpoint of current batch and can be retried
+    with get_connection(whisper_settings.NOTIFY_EMAIL_BACKEND, fail_silently=False) as connection:
+        for user, user_members in groupby(members, key=attrgetter('user')):
+            lock = f'whisper:notify:{user.pk}'
 
-    # TODO: not logged/away in only?
-    for user in get_user_model().objects.all():
-        unread_and_not_notified_rooms = Room.objects.unread_and_not_notified(user)
+            if not cache.add(lock, True, whisper_settings.NOTIFY_LOCK_TIMEOUT):
+                continue
 
-        if not unread_and_not_notified_rooms.exists():
-            continue
+            user_members = list(user_members)
+            batch.append((lock, user_members, build_notification(user, [member.room for member in user_members], templates)))
 
-        notify(user, unread_and_not_notified_rooms)
-        notified_users += 1
+            if len(batch) >= whisper_settings.NOTIFY_EMAIL_BATCH_SIZE:
+                notified_users += send_notifications(batch, connection, rate_limiter)
+                batch = []
 
-        for room in unread_and_not_notified_rooms:
-            member = RoomUser.objects.get(room=room, user=user)
-            member.last_notified = now()
-            member.save(update_fields=['last_notified'])
+        if batch:
+            notified_users += send_notifications(batch, connection, rate_limiter)
 
     return notified_users
 
 
-def notify(user, rooms):
+def send_notifications(batch, connection, rate_limiter):
     """
-    Send email notification about unread messages to room member
+    Send batch of notifications over single connection and record progress of notified members.
+    Members are not checkpointed if sending fails (error is raised).
+    """
+    from whisper.models import RoomUser
+
+    try:
+        rate_limiter.wait(len(batch))
+        connection.send_messages([message for lock, members, message in batch])
+
+        # checkpoint
+        RoomUser.objects.filter(pk__in=[member.pk for lock, members, message in batch for member in members]).update(last_notified=now())
+    finally:
+        cache.delete_many([lock for lock, members, message in batch])
+
+    return len(batch)
+
+
+class RateLimiter:
+    """
+    Blocks to keep number of sent emails under given rate (per second)
     """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.count = 0
 
-    # activate language
+    def wait(self, count):
+        if self.rate:
+            delay = self.started + self.count / self.rate - time.monotonic()
+
+            if delay > 0:
+                time.sleep(delay)
+
+        self.count += count
+
+
+def activate_language():
     language = settings.LANGUAGE_CODE  # TODO: pick from user profile
     translation.activate(language)
 
-    # add unread messages to room object
-    for room in rooms:
-        room.unread_messages = room.message_set.unread_by_user(user)
 
-    # templates
+def get_notification_templates():
     t = loader.get_template('whisper/mails/notification.txt')
 
     try:
@@ -62,6 +163,54 @@ def notify(user, rooms):
     except TemplateDoesNotExist:
         t_html = None
 
+    return t, t_html
+
+
+def notify(user, rooms):
+    """
+    Send email notification about unread messages to room member
+    """
+    activate_language()
+    build_notification(user, rooms, get_notification_templates()).send(fail_silently=True)
+
+
+def add_unread_digest(user, rooms):
+    """
+    Adds newest unread messages (unread_messages), total number of unread messages (unread_total)
+    and number of unread messages not listed (unread_more) to rooms, using single query
+    """
+    from whisper import settings as whisper_settings
+    from whisper.models import Message
+
+    messages = Message.objects\
+        .filter(room__in=rooms)\
+        .unread_digest(user, whisper_settings.NOTIFY_MESSAGES_PER_ROOM)\
+        .select_related('user')
+
+    room_messages = defaultdict(list)
+    room_totals = {}
+
+    for message in messages:
+        room_messages[message.room_id].append(message)
+        room_totals[message.room_id] = message.room_unread_total
+
+    for room in rooms:
+        room.unread_messages = sorted(room_messages[room.pk], key=attrgetter('created', 'pk'))
+        room.unread_total = room_totals.get(room.pk, 0)
+        room.unread_more = room.unread_total - len(room.unread_messages)
+
+
+def build_notification(user, rooms, templates):
+    """
+    Email notification about unread messages for room member
+    """
+
+    # add unread messages to room object
+    add_unread_digest(user, rooms)
+
+    # templates
+    t, t_html = templates
+
     # recipients
     recipient = user
     recipient_list = [recipient.email]
@@ -86,11 +235,9 @@ def notify(user, rooms):
     }
 
     # message
-    message = t.render(context)
-    html_message = t_html.render(context) if t_html else None
+    message = EmailMultiAlternatives(subject, t.render(context), settings.DEFAULT_FROM_EMAIL, recipient_list)
 
-    # mail arguments
-    from_email = settings.DEFAULT_FROM_EMAIL
-    fail_silently = True
+    if t_html:
+        message.attach_alternative(t_html.render(context), 'text/html')
 
-    send_mail(subject, message, from_email, recipient_list, html_message=html_message, fail_silently=fail_silently)
+    return message
@@ -0,0 +1,125 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Q, QuerySet
+from django.template import loader
+
+from whisper import settings
+
+
+class UserDirectory:
+    """
+    Prefix search over indexed user field with keyset pagination and shared cache of rendered user entries
+    """
+    @staticmethod
+    def get_search_field():
+        return settings.USER_SEARCH_FIELD or get_user_model().USERNAME_FIELD
+
+    @staticmethod
+    def get_users():
+        """
+        Users of WHISPER_CHAT_USERS as QuerySet (other iterables are converted, so they are evaluated on every search)
+        """
+        users = settings.CHAT_USERS()
+
+        if isinstance(users, QuerySet):
+            return users
+
+        return get_user_model().objects.filter(pk__in=[user.pk for user in users])
+
+    @staticmethod
+    def parse_cursor(after):
+        """
+        Returns cursor of next page sent by client ({'value': ..., 'id': ...}) or None if it is not valid
+        """
+        if not isinstance(after, dict):
+            return None
+
+        value, pk = after.get('value', None), after.get('id', None)
+
+        if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+            return None
+
+        if not isinstance(pk, int) or isinstance(pk, bool) or not 0 < pk < 2 ** 63:
+            return None
+
+        return {'value': value, 'id': pk}
+
+    def search(self, queryset, query='', after=None, limit=None):
+        """
+        Returns page of users and cursor of next page (None if there are no more users)
+
+        :param after: cursor returned with previous page, invalid cursors are ignored
+        """
+        limit = min(limit or settings.USER_DIRECTORY_PAGE_SIZE, settings.USER_DIRECTORY_PAGE_SIZE)
+        field = self.get_search_field()
+        after = self.parse_cursor(after)
+
+        if query and isinstance(query, str):
+            queryset = queryset.filter(**{f'{field}__startswith': query})
+
+        if after is not None:
+            queryset = queryset.filter(Q(**{f'{field}__gt': after['value']}) | Q(**{field: after['value'], 'pk__gt': after['id']}))
+
+        # fetch one extra user to find out if there is next page
+        users = list(queryset.order_by(field, 'pk')[:limit + 1])
+        next_cursor = None
+
+        if len(users) > limit:
+            users = users[:limit]
+            next_cursor = {'value': getattr(users[-1], field), 'id': users[-1].pk}
+
+        return users, next_cursor
+
+    @staticmethod
+    def get_entry_key(user_pk):
+        return f'whisper:user-entry:{user_pk}'
+
+    def render_entries(self, users):
+        """
+        Rendered whisper/user.html of users by their pk, shared by all viewers
+        """
+        keys = {self.get_entry_key(user.pk): user for user in users}
+        cached = cache.get_many(keys.keys())
+        entries = {keys[key].pk: html for key, html in cached.items()}
+        missing = {}
+
+        if len(entries) < len(users):
+            template = loader.get_template('whisper/user.html')
+
+            for key, user in keys.items():
+                if user.pk not in entries:
+                    entries[user.pk] = missing[key] = template.render({'user': user})
+
+            cache.set_many(missing, settings.USER_ENTRY_CACHE_TIMEOUT)
+
+        return entries
+
+    @staticmethod
+    def get_members_key(room, viewer_pk):
+        # fingerprint of current members works as membership version of room
+        return f'whisper:member-list:{room.pk}:{room.get_member_hash(room.member_ids)}:{viewer_pk}'
+
+    def get_members(self, room, viewer):
+        """
+        Members of room with rendered whisper/member.html, cached per membership version of room and viewer
+        """
+        from whisper.models import RoomUser
+
+        key = self.get_members_key(room, viewer.pk)
+        members = cache.get(key)
+
+        if members is None:
+            template = loader.get_template('whisper/member.html')
+            is_user_to_user = room.is_user_to_user_room
+            members = [{
+                'id': user.pk,
+                'name': str(user),
+                'removable': user.pk != viewer.pk and not is_user_to_user,
+                'html': template.render({'user': user, 'scope_user': viewer, 'is_user_to_user': is_user_to_user}),
+            } for user in RoomUser.get_users(room)]
+            cache.set(key, members, settings.USER_ENTRY_CACHE_TIMEOUT)
+
+        return members
+
+
+user_directory = UserDirectory()
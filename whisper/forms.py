@@ -1,8 +1,7 @@
-import json
-
 from asgiref.sync import async_to_sync
 from django import forms
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
 from django.forms import ModelMultipleChoiceField
 from django.utils.timezone import now
 try:
@@ -16,6 +15,32 @@ from whisper.helpers import ChatMessageHelper
 from whisper.models import Room, RoomUser
 
 
+class UserAutocompleteWidget(forms.SelectMultiple):
+    """
+    Renders only selected users instead of all choices, other users are searched by client
+    (search_members message of chat socket)
+    """
+    def __init__(self, attrs=None, choices=()):
+        attrs = {'data-autocomplete': 'users', **(attrs or {})}
+        super().__init__(attrs, choices)
+
+    def optgroups(self, name, value, attrs=None):
+        choices = self.choices
+        selected = [selected_value for selected_value in value if selected_value not in ('', None)]
+
+        if hasattr(choices, 'queryset'):
+            try:
+                queryset = choices.queryset.filter(pk__in=selected) if selected else choices.queryset.none()
+                self.choices = [choices.choice(obj) for obj in queryset]
+            except (ValueError, TypeError, ValidationError):
+                self.choices = []
+
+        try:
+            return super().optgroups(name, value, attrs)
+        finally:
+            self.choices = choices
+
+
 class RoomAddMemberForm(forms.ModelForm):
     class Meta:
         model = Room
@@ -23,6 +48,8 @@ class RoomAddMemberForm(forms.ModelForm):
 
     def __init__(self, current_user=None, *args, **kwargs):
         room_pk = kwargs.pop('room_pk', None)
+        # autocomplete widget needs search UI of chat socket (search_members), pages use plain select
+        autocomplete = kwargs.pop('autocomplete', False)
         super().__init__(*args, **kwargs)
         self.current_user = current_user
 
@@ -31,11 +58,17 @@ class RoomAddMemberForm(forms.ModelForm):
         else:
             self.possible_users = get_user_model().objects.all()
 
-        self.fields['users'] = ModelMultipleChoiceField(required=True, queryset=self.possible_users)
+        widget = UserAutocompleteWidget if autocomplete else forms.SelectMultiple
+        self.fields['users'] = ModelMultipleChoiceField(required=True, queryset=self.possible_users, widget=widget)
 
     def clean(self):
         cleaned_data = super().clean()
         users = cleaned_data.get('users', None)
+
+        if users is None:
+            # invalid or stale user ids, error already added by field
+            return cleaned_data
+
         users = set(users.values_list('pk', flat=True))
         current_users = RoomUser.get_users(self.instance)
         current_users = set(current_users.values_list('id', flat=True))
@@ -56,15 +89,18 @@ class RoomAddMemberForm(forms.ModelForm):
             users = list(users.values_list('pk', flat=True))
             return Room.objects.get_or_create_from_users(users)
         else:
-            for current_user in current_users:
-                if current_user not in users:
-                    async_to_sync(ChatMessageHelper.send_message)(self.instance, json.dumps({'USER_LEFT': {'username': str(current_user)}}))
-                    RoomUser.objects.filter(user=current_user, room=self.instance).delete()
-
-            if users is not None:
-                for user in users:
-                    if user not in current_users:
-                        RoomUser.objects.update_or_create(room=self.instance, user=user, defaults={'last_read': now()})
-                        async_to_sync(ChatMessageHelper.send_message)(self.instance, json.dumps({'USER_JOINED': {'username': str(user)}}))
+            users = set(users) if users is not None else set()
+            current_users = set(current_users)
+
+            removed_users = current_users - users
+            added_users = users - current_users
+
+            if removed_users:
+                self.instance.remove_users(removed_users)
+                async_to_sync(ChatMessageHelper.send_membership_message)(self.instance, removed_users, joined=False)
+
+            if added_users:
+                self.instance.add_users(added_users, last_read=now())
+                async_to_sync(ChatMessageHelper.send_membership_message)(self.instance, added_users, joined=True)
 
             return super().save(commit)
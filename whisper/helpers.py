@@ -1,45 +1,232 @@
+import json
+
+from asgiref.sync import async_to_sync
 from channels.db import database_sync_to_async
-from channels.layers import get_channel_layer
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
 from django.template.defaultfilters import date
 from django.templatetags.tz import localtime
 
 from whisper import settings
-from whisper.models import Message
+from whisper.instrumentation import get_channel_layer, measure
+from whisper.models import Message, RoomUser
 
 
 class ChatMessageHelper:
-    # send system message
+    # send system message (or user message if sender is given)
     @staticmethod
     async def send_message(room, text_message, sender=None):
-        message = Message.objects.create(
-            room=room,
-            user=sender,
-            text=text_message,
-        )
+        with measure('send_message', 'ChatMessageHelper', 'helper'):
+            message = await ChatMessageHelper.create_message(room, text_message, sender)
 
-        # update modified timestamp
-        room.save()
+            channel_layer = get_channel_layer()
+            unread_event = None
 
-        channel_layer = get_channel_layer()
+            if sender is not None:
+                # system messages don't change unread counts
+                unread_event = {
+                    'type': 'chat_message',
+                    'room_id': room.pk,
+                    'sender_id': sender.pk,
+                    'delta': 1,
+                    'seq': await database_sync_to_async(ChatMessageHelper.next_unread_sequence)(room),
+                }
 
-        # Send message to room group
-        await channel_layer.group_send(
-            room.group_name, {
-                'type': 'chat_message',
-                'message': str(message),
-                'username': str(sender) if sender is not None else None,
-                'timestamp': date(localtime(message.created), settings.DATETIME_FORMAT)
-            }
-        )
-
-        for group_name in room.user_groups:
-            await channel_layer.group_send(
-                group_name, {
+            # Send message to room group and unread consumers of room members
+            await ChatMessageHelper.broadcast_message(
+                channel_layer, room, {
                     'type': 'chat_message',
+                    'uuid': str(message.uuid),
+                    'message': str(message),
+                    'username': str(sender) if sender is not None else None,
+                    'timestamp': date(localtime(message.created), settings.DATETIME_FORMAT)
+                }, unread_event
+            )
+
+            await ChatMessageHelper.send_room_properties(room, channel_layer)
+
+    @staticmethod
+    async def send_membership_message(room, users, joined=True):
+        """
+        Sends single system message about users who joined or left the room
+        """
+        usernames = [str(user) for user in users]
+
+        if not usernames:
+            return
+
+        if len(usernames) == 1:
+            message_type = 'USER_JOINED' if joined else 'USER_LEFT'
+            params = {'username': usernames[0]}
+        else:
+            message_type = 'USERS_JOINED' if joined else 'USERS_LEFT'
+            params = {'usernames': ', '.join(usernames)}
+
+        await ChatMessageHelper.send_message(room, json.dumps({message_type: params}))
+
+    @staticmethod
+    async def broadcast_message(channel_layer, room, event, unread_event=None):
+        """
+        Sends message to chat consumers of room and unread event to unread consumers subscribed to the room,
+        so it costs constant number of channel layer operations regardless of number of room members
+        """
+        await channel_layer.group_send(room.group_name, event)
+
+        if unread_event is not None:
+            await channel_layer.group_send(room.unread_group_name, unread_event)
+
+    @staticmethod
+    def send_membership_event(room_pk, user_pk, event_type):
+        """
+        Tells unread consumers of user to (un)subscribe room events. Must be called from sync code.
+        """
+        channel_layer = get_channel_layer()
+
+        if channel_layer is not None:
+            async_to_sync(channel_layer.group_send)(
+                f'unread-chat-messages-{user_pk}', {
+                    'type': event_type,
+                    'room_id': room_pk,
                 }
             )
 
-        await ChatMessageHelper.send_room_properties(room, channel_layer)
+    @staticmethod
+    @database_sync_to_async
+    def create_message(room, text_message, sender=None):
+        from whisper.cache import recent_rooms_cache
+        from whisper.writers import room_activity
+
+        with transaction.atomic():
+            message = Message.objects.create(
+                room=room,
+                user=sender,
+                text=text_message,
+            )
+
+            if sender is not None:
+                # unread counters of other room members
+                RoomUser.objects.increment_unread(room, sender, message.created)
+
+            # update modified timestamp right away, helper is often called by short-lived processes (RQ jobs, commands)
+            room_activity.update(room.pk, message.created)
+
+        recent_rooms_cache.invalidate_room(room.pk)
+
+        return message
+
+    @staticmethod
+    def serialize_message(message):
+        return {
+            'id': message.pk,
+            'uuid': str(message.uuid) if message.uuid else None,
+            'created': message.created.isoformat(),
+            'message': message.get_rendered_text(),
+            'timestamp': date(localtime(message.created), settings.DATETIME_FORMAT),
+            'username': str(message.user) if message.user is not None else None,
+        }
+
+    # unread events checked by resync of unread consumers for messages not stored yet (per room)
+    PENDING_UNREAD_WINDOW = 100
+
+    @staticmethod
+    def get_sequence_cache():
+        """
+        Cache of unread sequences or None if it's local to process (every process would have its own sequences
+        and every event would look like a lost one)
+        """
+        sequence_cache = caches[settings.UNREAD_SEQUENCE_CACHE]
+        return None if isinstance(sequence_cache, (LocMemCache, DummyCache)) else sequence_cache
+
+    @staticmethod
+    def unread_sequence_key(room_pk):
+        return f'whisper:unread-sequence:{room_pk}'
+
+    @staticmethod
+    def pending_unread_key(room_pk, sequence):
+        return f'whisper:unread-pending:{room_pk}:{sequence}'
+
+    @staticmethod
+    def next_unread_sequence(room, pending_sender=None):
+        """
+        Returns next number of per room sequence used by unread consumers to detect lost events
+        (None if sequences are disabled)
+
+        :param pending_sender: sender of message which is not stored yet, its event is pending until it is
+        """
+        sequence_cache = ChatMessageHelper.get_sequence_cache()
+
+        if sequence_cache is None:
+            return None
+
+        key = ChatMessageHelper.unread_sequence_key(room.pk)
+        sequence_cache.add(key, 0, timeout=None)
+
+        try:
+            sequence = sequence_cache.incr(key)
+        except ValueError:
+            # key evicted in the meantime
+            sequence = 1
+            sequence_cache.set(key, sequence, timeout=None)
+
+        if pending_sender is not None:
+            sequence_cache.set(ChatMessageHelper.pending_unread_key(room.pk, sequence), pending_sender.pk, settings.UNREAD_PENDING_TIMEOUT)
+
+        return sequence
+
+    @staticmethod
+    def discard_pending_unread(events):
+        """
+        Marks unread events of stored (or lost) messages as not pending
+
+        :param events: list of (room_pk, sequence)
+        """
+        sequence_cache = ChatMessageHelper.get_sequence_cache()
+        events = [(room_pk, sequence) for room_pk, sequence in events if sequence is not None]
+
+        if sequence_cache is None or not events:
+            return
+
+        sequence_cache.delete_many([ChatMessageHelper.pending_unread_key(room_pk, sequence) for room_pk, sequence in events])
+
+    @staticmethod
+    def get_unread_sequences(room_pks):
+        sequence_cache = ChatMessageHelper.get_sequence_cache()
+
+        if sequence_cache is None:
+            return {}
+
+        keys = {ChatMessageHelper.unread_sequence_key(room_pk): room_pk for room_pk in room_pks}
+        return {keys[key]: sequence for key, sequence in sequence_cache.get_many(keys.keys()).items()}
+
+    @staticmethod
+    def count_pending_unread(sequences, user_pk):
+        """
+        Returns counts of messages by room which are sent, but not stored yet (in write-behind buffers),
+        so they are not included in unread counters of members yet
+
+        :param sequences: current sequences by room pk
+        """
+        sequence_cache = ChatMessageHelper.get_sequence_cache()
+
+        if sequence_cache is None or not sequences:
+            return {}
+
+        keys = {}
+
+        # messages are stored out of order by writers of different processes, every key in window is checked
+        for room_pk, sequence in sequences.items():
+            for pending_sequence in range(max(sequence - ChatMessageHelper.PENDING_UNREAD_WINDOW, 0) + 1, sequence + 1):
+                keys[ChatMessageHelper.pending_unread_key(room_pk, pending_sequence)] = room_pk
+
+        counts = {}
+
+        for key, sender_pk in sequence_cache.get_many(keys.keys()).items():
+            if sender_pk != user_pk:
+                counts[keys[key]] = counts.get(keys[key], 0) + 1
+
+        return counts
 
     @staticmethod
     def message_from_type(type, **params):
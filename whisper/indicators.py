@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from whisper import settings
+from whisper.helpers import ChatMessageHelper
+
+
+class TypingIndicator:
+    """
+    Per connection state of users typing in room.
+
+    Typing events of connected user are throttled to one per WHISPER_TYPING_THROTTLE seconds.
+    Typing events of other users are merged and sent to the client at most once
+    per WHISPER_TYPING_BROADCAST_INTERVAL seconds, only when the list of typing users changes.
+    """
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.last_sent = None
+        self.typing_users = {}
+        self.sent_usernames = []
+        self.task = None
+
+    async def typing(self, is_typing=True):
+        """
+        Broadcasts typing state of connected user to the room
+        """
+        current_time = time.monotonic()
+
+        if is_typing:
+            if self.last_sent is not None and current_time - self.last_sent < settings.TYPING_THROTTLE:
+                return
+
+            self.last_sent = current_time
+        else:
+            if self.last_sent is None:
+                # nothing to stop
+                return
+
+            self.last_sent = None
+
+        await self.consumer.channel_layer.group_send(
+            self.consumer.room.group_name, {
+                'type': 'user_typing',
+                'user_id': self.consumer.user.pk,
+                'username': str(self.consumer.user),
+                'typing': is_typing,
+            }
+        )
+
+    def receive(self, event):
+        """
+        Records typing state of other user in the room
+        """
+        if event['user_id'] == self.consumer.user.pk:
+            return
+
+        if event['typing']:
+            self.typing_users[event['user_id']] = (event['username'], time.monotonic() + settings.TYPING_TIMEOUT)
+        else:
+            self.typing_users.pop(event['user_id'], None)
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.broadcast())
+
+    async def broadcast(self):
+        while True:
+            current_time = time.monotonic()
+            self.typing_users = {user_id: (username, expires) for user_id, (username, expires) in self.typing_users.items() if expires > current_time}
+            usernames = sorted(username for username, expires in self.typing_users.values())
+
+            if usernames != self.sent_usernames:
+                self.sent_usernames = usernames
+
+                await self.consumer.send_json(content={
+                    'type': 'user_typing',
+                    'usernames': usernames,
+                    'text': self.get_text(usernames),
+                })
+
+            if not self.typing_users:
+                return
+
+            await asyncio.sleep(settings.TYPING_BROADCAST_INTERVAL)
+
+    @staticmethod
+    def get_text(usernames):
+        if not usernames:
+            return ''
+
+        if len(usernames) == 1:
+            return ChatMessageHelper.message_from_type('USER_TYPING', username=usernames[0])
+
+        return ChatMessageHelper.message_from_type('USERS_TYPING', usernames=', '.join(usernames))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
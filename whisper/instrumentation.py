@@ -0,0 +1,314 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from channels import DEFAULT_CHANNEL_LAYER
+from channels.layers import get_channel_layer as channels_get_channel_layer
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+from whisper import settings
+
+# sent with every finished measurement (keyword argument measurement)
+event_measured = Signal()
+
+current_measurement = ContextVar('whisper_measurement', default=None)
+
+
+class Measurement:
+    """
+    Duration, DB queries, channel layer sends and sent frames of single consumer (or helper) event
+    """
+    def __init__(self, event, consumer='', source=''):
+        self.event = event
+        self.consumer = consumer
+        self.source = source
+        self.parent = None
+        self.started = time.perf_counter()
+        self.duration = None
+        self.queries = 0
+        self.query_duration = 0
+        self.sends = 0
+        self.frames = 0
+        self.frame_bytes = 0
+
+    @property
+    def finished(self):
+        return self.duration is not None
+
+    @property
+    def labels(self):
+        return self.consumer, self.source, self.event
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+        # nested measurement is part of the outer one as well
+        if self.parent is not None and not self.parent.finished:
+            self.parent.queries += self.queries
+            self.parent.query_duration += self.query_duration
+            self.parent.sends += self.sends
+            self.parent.frames += self.frames
+            self.parent.frame_bytes += self.frame_bytes
+
+    def as_dict(self):
+        return {
+            'event': self.event,
+            'consumer': self.consumer,
+            'source': self.source,
+            'duration': self.duration,
+            'queries': self.queries,
+            'query_duration': self.query_duration,
+            'sends': self.sends,
+            'frames': self.frames,
+            'frame_bytes': self.frame_bytes,
+        }
+
+
+def get_measurement():
+    # tasks and threads started by measured event (e.g. write-behind buffers) can outlive it
+    measurement = current_measurement.get()
+    return measurement if measurement is not None and not measurement.finished else None
+
+
+@contextmanager
+def measure(event, consumer='', source=''):
+    """
+    Measures block of code and emits the measurement (event_measured signal and WHISPER_INSTRUMENTATION_CALLBACK)
+    """
+    if not settings.INSTRUMENTATION:
+        yield None
+        return
+
+    measurement = Measurement(event, consumer, source)
+    measurement.parent = get_measurement()
+    token = current_measurement.set(measurement)
+
+    try:
+        yield measurement
+    finally:
+        current_measurement.reset(token)
+        measurement.finish()
+        emit(measurement)
+
+
+def emit(measurement):
+    event_measured.send(sender=Measurement, measurement=measurement)
+
+    if settings.INSTRUMENTATION_CALLBACK:
+        import_string(settings.INSTRUMENTATION_CALLBACK)(measurement)
+
+
+def record_send(count=1):
+    measurement = get_measurement()
+
+    if measurement is not None:
+        measurement.sends += count
+
+
+class InstrumentedChannelLayer:
+    """
+    Channel layer proxy counting sends of measured events
+    """
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+
+    def __getattr__(self, name):
+        return getattr(self.channel_layer, name)
+
+    async def send(self, channel, message):
+        record_send()
+        await self.channel_layer.send(channel, message)
+
+    async def group_send(self, group, message):
+        record_send()
+        await self.channel_layer.group_send(group, message)
+
+
+def instrument_channel_layer(channel_layer):
+    if channel_layer is None or not settings.INSTRUMENTATION or isinstance(channel_layer, InstrumentedChannelLayer):
+        return channel_layer
+
+    return InstrumentedChannelLayer(channel_layer)
+
+
+def get_channel_layer(alias=DEFAULT_CHANNEL_LAYER):
+    return instrument_channel_layer(channels_get_channel_layer(alias))
+
+
+def record_frame(text_data=None, bytes_data=None):
+    measurement = get_measurement()
+
+    if measurement is not None:
+        measurement.frames += 1
+        measurement.frame_bytes += len(bytes_data) if bytes_data is not None else len((text_data or '').encode())
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Execute wrapper of database connections
+    """
+    measurement = get_measurement()
+
+    if measurement is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        measurement.queries += 1
+        measurement.query_duration += time.perf_counter() - started
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    # connected to connection_created, consumers run queries in worker threads with their own connections
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class InstrumentedConsumerMixin:
+    """
+    Measures every handled message of consumer: websocket connect/disconnect,
+    received client events (by their JSON type) and channel layer events.
+    Channel layer sends are counted by proxy of consumer's channel layer.
+    Client event types not listed in receive_events are measured as default_receive_event,
+    so clients can't create arbitrary metrics.
+    """
+    receive_events = ()
+    default_receive_event = 'receive'
+
+    @property
+    def channel_layer(self):
+        return self.__dict__.get('channel_layer', None)
+
+    @channel_layer.setter
+    def channel_layer(self, channel_layer):
+        # set by consumer when it's called, sends of all handlers are counted by proxy
+        self.__dict__['channel_layer'] = instrument_channel_layer(channel_layer)
+
+    async def dispatch(self, message):
+        message_type = message['type']
+
+        if message_type == 'websocket.receive':
+            event, source = self.default_receive_event, 'client'
+        elif message_type.startswith('websocket.'):
+            event, source = message_type[len('websocket.'):], 'websocket'
+        else:
+            event, source = message_type, 'group'
+
+        with measure(event, type(self).__name__, source):
+            await super().dispatch(message)
+
+    @classmethod
+    async def decode_json(cls, text_data):
+        content = await super().decode_json(text_data)
+        measurement = get_measurement()
+
+        if measurement is not None and isinstance(content, dict) and content.get('type', None) in cls.receive_events:
+            measurement.event = content['type']
+
+        return content
+
+    @classmethod
+    async def encode_json(cls, content):
+        # every frame sent by JSON consumer is encoded here
+        text_data = await super().encode_json(content)
+        record_frame(text_data)
+        return text_data
+
+
+class MetricsAggregator:
+    """
+    In-memory totals of measurements by (consumer, source, event), exported in Prometheus text format
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    COUNTERS = (
+        ('queries', 'whisper_event_queries_total', 'DB queries executed by events'),
+        ('query_duration', 'whisper_event_query_duration_seconds_total', 'Time spent in DB queries by events'),
+        ('sends', 'whisper_event_channel_sends_total', 'Channel layer sends of events'),
+        ('frames', 'whisper_event_frames_total', 'Frames sent to websockets by events'),
+        ('frame_bytes', 'whisper_event_frame_bytes_total', 'Size of frames sent to websockets by events'),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.totals = defaultdict(lambda: defaultdict(float))
+            self.buckets = defaultdict(lambda: [0] * len(self.BUCKETS))
+
+    def record(self, measurement):
+        with self.lock:
+            totals = self.totals[measurement.labels]
+            totals['count'] += 1
+            totals['duration'] += measurement.duration
+
+            for attribute, name, description in self.COUNTERS:
+                totals[attribute] += getattr(measurement, attribute)
+
+            buckets = self.buckets[measurement.labels]
+
+            for index, bound in enumerate(self.BUCKETS):
+                if measurement.duration <= bound:
+                    buckets[index] += 1
+
+    def receive(self, sender, measurement, **kwargs):
+        # event_measured receiver
+        self.record(measurement)
+
+    def get_totals(self, event, consumer=None, source=None):
+        """
+        Totals of event (summed over consumers and sources unless specified)
+        """
+        result = defaultdict(float)
+
+        with self.lock:
+            for (label_consumer, label_source, label_event), totals in self.totals.items():
+                if label_event == event and consumer in (None, label_consumer) and source in (None, label_source):
+                    for key, value in totals.items():
+                        result[key] += value
+
+        return dict(result)
+
+    @staticmethod
+    def format_labels(labels, **extra):
+        consumer, source, event = labels
+        labels = {'consumer': consumer, 'source': source, 'event': event, **extra}
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+    def export(self):
+        with self.lock:
+            totals = {labels: dict(values) for labels, values in self.totals.items()}
+            buckets = {labels: list(values) for labels, values in self.buckets.items()}
+
+        lines = [
+            '# HELP whisper_event_duration_seconds Duration of consumer events',
+            '# TYPE whisper_event_duration_seconds histogram',
+        ]
+
+        for labels, values in sorted(totals.items()):
+            for bound, count in zip(self.BUCKETS, buckets[labels]):
+                lines.append(f'whisper_event_duration_seconds_bucket{self.format_labels(labels, le=bound)} {count}')
+
+            lines.append(f'whisper_event_duration_seconds_bucket{self.format_labels(labels, le="+Inf")} {int(values["count"])}')
+            lines.append(f'whisper_event_duration_seconds_sum{self.format_labels(labels)} {values["duration"]}')
+            lines.append(f'whisper_event_duration_seconds_count{self.format_labels(labels)} {int(values["count"])}')
+
+        for attribute, name, description in self.COUNTERS:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} counter')
+
+            for labels, values in sorted(totals.items()):
+                lines.append(f'{name}{self.format_labels(labels)} {values[attribute]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+aggregator = MetricsAggregator()
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from whisper.models import Message
+
+
+class Command(BaseCommand):
+    help = 'Precomputes render fields of messages created before they were stored at write time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        messages = Message.objects.filter(rendered_text='', system_type=None).order_by('pk')
+        fields = Message.RENDER_FIELDS
+        batch = []
+        updated = 0
+
+        for message in messages.iterator(chunk_size=batch_size):
+            message.prepare_render_fields()
+            batch.append(message)
+
+            if len(batch) >= batch_size:
+                updated += Message.objects.bulk_update(batch, fields)
+                batch = []
+
+        if batch:
+            updated += Message.objects.bulk_update(batch, fields)
+
+        self.stdout.write(self.style.SUCCESS(f'{updated} messages updated'))
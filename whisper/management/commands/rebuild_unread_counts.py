@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from whisper.models import RoomUser
+
+
+class Command(BaseCommand):
+    help = 'Reconciles unread messages counters of room members with existing messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report members with out of sync counters')
+
+    def handle(self, *args, **options):
+        members = RoomUser.objects.out_of_sync()
+
+        if options['dry_run']:
+            self.stdout.write(f'{members.count()} room members have out of sync unread counters')
+            return
+
+        updated = members.update(unread_count=F('actual_unread_count'))
+        self.stdout.write(self.style.SUCCESS(f'{updated} unread counters reconciled'))
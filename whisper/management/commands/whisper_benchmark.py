@@ -0,0 +1,242 @@
+import asyncio
+import json
+import math
+import os
+import platform
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import channels
+import django
+from channels.db import database_sync_to_async
+from channels.layers import channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from whisper import settings
+from whisper.models import Room
+from whisper.routing import websocket_urlpatterns
+from whisper.writers import room_activity
+
+
+class QueryCounter:
+    """
+    Counts queries executed by all database connections (consumers run queries in worker threads)
+    """
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def percentiles(values):
+    values = sorted(values)
+
+    def percentile(p):
+        # nearest rank
+        if not values:
+            return None
+
+        return round(values[max(0, math.ceil(len(values) * p / 100) - 1)] * 1000, 3)
+
+    return {'p50': percentile(50), 'p99': percentile(99), 'max': percentile(100)}
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks chat consumers (rooms x members x message rate) with in-memory channel layer on test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--members', type=int, default=5, help='Members per room')
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent to every room')
+        parser.add_argument('--rate', type=float, default=10, help='Messages per second sent to every room')
+        parser.add_argument('--timeout', type=float, default=5, help='Seconds to wait for single frame')
+        parser.add_argument('--output', help='Write results as JSON to file (e.g. benchmarks/baseline.json)')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.counter = QueryCounter()
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'whisper-benchmark'}},
+        ):
+            database_options = connection.settings_dict.get('OPTIONS', {})
+
+            if connection.vendor == 'sqlite':
+                # file database can be shared by worker threads of consumers
+                connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(directory, 'whisper_benchmark.sqlite3')
+
+                if django.VERSION >= (5, 1):
+                    # concurrent read-then-write transactions (update_or_create) of worker threads fail on deferred transactions
+                    connection.settings_dict['OPTIONS'] = {**database_options, 'transaction_mode': 'IMMEDIATE'}
+
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+            if connection.vendor == 'sqlite':
+                # readers of worker threads don't block writers (persistent setting of database file)
+                with connection.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode=WAL')
+
+            channel_layers.backends.clear()
+            connection_created.connect(self.counter.install)
+
+            try:
+                rooms = self.create_rooms()
+                results = asyncio.run(self.benchmark(rooms))
+            finally:
+                connection_created.disconnect(self.counter.install)
+                channel_layers.backends.clear()
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                connection.settings_dict['OPTIONS'] = database_options
+
+        output = json.dumps(results, indent=2)
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+
+        self.stdout.write(output)
+
+    def create_rooms(self):
+        user_model = get_user_model()
+        rooms = []
+
+        for room_index in range(self.options['rooms']):
+            users = [
+                user_model.objects.create(**{user_model.USERNAME_FIELD: f'benchmark-{room_index}-{member_index}'})
+                for member_index in range(self.options['members'])
+            ]
+            room = Room.objects.create_group()
+            room.add_users(users)
+            rooms.append((room, users))
+
+        return rooms
+
+    async def connect(self, path, user):
+        communicator = WebsocketCommunicator(self.application, path)
+        communicator.scope['user'] = user
+        started = time.perf_counter()
+        connected, code = await communicator.connect(timeout=self.options['timeout'])
+
+        if not connected:
+            raise RuntimeError(f'Connection to {path} refused ({code})')
+
+        return communicator, time.perf_counter() - started
+
+    @staticmethod
+    async def drain(communicator):
+        while not await communicator.receive_nothing(timeout=0.05):
+            await communicator.receive_output()
+
+    async def receive(self, communicator, started, match):
+        while True:
+            frame = await communicator.receive_json_from(timeout=self.options['timeout'])
+
+            if match(frame):
+                return time.perf_counter() - started
+
+    async def send_messages(self, room, members):
+        latencies = []
+        sender, sender_chat, sender_unread = members[0]
+        interval = 1 / self.options['rate'] if self.options['rate'] else 0
+
+        for index in range(self.options['messages']):
+            text = f'benchmark message {index} of room {room.pk}'
+            started = time.perf_counter()
+            await sender_chat.send_json_to({'message': text})
+
+            receipts = [
+                self.receive(chat, started, lambda frame: frame.get('type') == 'chat_message' and frame.get('message') == text)
+                for user, chat, unread in members
+            ] + [
+                # sender is not notified about own messages
+                self.receive(unread, started, lambda frame: 'unread_messages' in frame)
+                for user, chat, unread in members[1:]
+            ]
+
+            latencies.extend(await asyncio.gather(*receipts))
+            await asyncio.sleep(max(0, started + interval - time.perf_counter()))
+
+        return latencies
+
+    async def benchmark(self, rooms):
+        self.application = URLRouter(websocket_urlpatterns)
+
+        # connect
+        tracemalloc.start()
+        memory = tracemalloc.get_traced_memory()[0]
+        queries = self.counter.count
+        connect_latencies = []
+        room_members = []
+
+        for room, users in rooms:
+            members = []
+
+            for user in users:
+                chat, chat_latency = await self.connect(f'/ws/chat/{room.slug}/', user)
+                unread, unread_latency = await self.connect('/ws/chat/unread-messages/', user)
+                connect_latencies.extend([chat_latency, unread_latency])
+                members.append((user, chat, unread))
+
+            room_members.append((room, members))
+
+        for room, members in room_members:
+            for user, chat, unread in members:
+                await self.drain(chat)
+                await self.drain(unread)
+
+        connections = len(connect_latencies)
+        connect_queries = self.counter.count - queries
+        memory_per_connection = (tracemalloc.get_traced_memory()[0] - memory) / connections
+        tracemalloc.stop()
+
+        # messages
+        queries = self.counter.count
+        fanout_latencies = []
+
+        for latencies in await asyncio.gather(*[self.send_messages(room, members) for room, members in room_members]):
+            fanout_latencies.extend(latencies)
+
+        # wait for write-behind buffers, so their queries are counted too
+        await asyncio.sleep(settings.MESSAGE_FLUSH_INTERVAL * 2)
+        await database_sync_to_async(room_activity.flush)()
+        messages = len(room_members) * self.options['messages']
+        message_queries = self.counter.count - queries
+
+        for room, members in room_members:
+            for user, chat, unread in members:
+                await chat.disconnect()
+                await unread.disconnect()
+
+        return {
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'channels': channels.__version__,
+                'database': connection.vendor,
+            },
+            'config': {key: self.options[key] for key in ['rooms', 'members', 'messages', 'rate']},
+            'connections': connections,
+            'connect_latency_ms': percentiles(connect_latencies),
+            'fanout_latency_ms': percentiles(fanout_latencies),
+            'queries_per_connection': round(connect_queries / connections, 2),
+            'queries_per_message': round(message_queries / messages, 2) if messages else None,
+            'memory_per_connection_kb': round(memory_per_connection / 1024, 2),
+        }
@@ -1,12 +1,11 @@
 from datetime import timedelta
 
-from django.apps import apps
-from django.db import transaction
+from django.db import transaction, IntegrityError
 
 from whisper import settings
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import QuerySet, Count, Q, F
+from django.db.models import QuerySet, Count, Q, F, OuterRef, Subquery, Case, When, Value, Window
+from django.db.models.functions import Coalesce, RowNumber
 from django.template.defaultfilters import title
 from django.utils.timezone import now
 
@@ -16,39 +15,41 @@ class RoomQuerySet(QuerySet):
         room_name, users = self.get_room_name_and_users_from_slug(slug)
         room = self.update_or_create(slug=slug, defaults={'name': room_name})[0]
 
-        from whisper.models import RoomUser
-        for user in users:
-            RoomUser.objects.get_or_create(room=room, user=user, defaults={'last_read': now()})
+        users = list(users)
 
-        if creator:
-            RoomUser.objects.get_or_create(room=room, user=creator, defaults={'last_read': now()})
+        if creator and creator not in users:
+            users.append(creator)
 
+        room.add_users(users, last_read=now())
         return room
 
     @transaction.atomic
-    def create_group(self):
-        room = self.create()
+    def create_group(self, member_hash=None):
+        room = self.create(member_hash=member_hash)
         room.slug = "group-" + str(room.pk)
         room.name = "Group #" + str(room.pk)
         room.save(update_fields=['slug', 'name'])
         return room
 
     def get_or_create_from_users(self, user_ids):
-        users_room = self.filter(slug__startswith='group').annotate(cnt=Count('users')).filter(cnt=len(user_ids))
-
-        for user_id in user_ids:
-            users_room = users_room.filter(users__pk=user_id)
+        from whisper.models import Room, RoomUser
+        user_ids = set(user_ids)
+        member_hash = Room.get_member_hash(user_ids)
+        users_room = self.filter(slug__startswith='group-', member_hash=member_hash).order_by('-created').first()
 
         if users_room:
-            return users_room.latest()
-        else:
-            new_room = self.create_group()
+            return users_room
 
-            from whisper.models import RoomUser
-            for user_id in user_ids:
-                RoomUser.objects.get_or_create(room=new_room, user_id=user_id, defaults={'last_read': now()})
+        try:
+            with transaction.atomic():
+                new_room = self.create_group(member_hash)
+                RoomUser.objects.bulk_create([RoomUser(room=new_room, user_id=user_id, last_read=now()) for user_id in user_ids])
+        except IntegrityError:
+            # group with the same members has been created in the meantime
+            return self.get(slug__startswith='group-', member_hash=member_hash)
 
-            return new_room
+        new_room.membership_changed(user_ids, 'room_joined')
+        return new_room
 
     @staticmethod
     def get_room_name_and_users_from_slug(slug):
@@ -61,30 +62,26 @@ class RoomQuerySet(QuerySet):
             users = get_user_model().objects.filter(pk__in=user_pks)
             room_name = ' & '.join(list(map(str, users)))
         else:
+            from whisper.registry import registry
             subject_pk = slug_parts[1]
-            obj_name = f'#{subject_pk}'
-
-            for model in apps.get_models():
-                if subject == model.__name__.lower():
-                    model_name = model._meta.verbose_name
-                    obj = model.objects.get(pk=subject_pk)
-                    users = obj.room_members
-                    obj_name = str(obj)
+            model = registry.get_model(subject)
 
-            room_name = title(f'{model_name} {obj_name}')
+            if model is None:
+                room_name = title(f'{subject} #{subject_pk}')
+            else:
+                obj = registry.get_object(subject, subject_pk)
+                users = obj.room_members
+                room_name = title(f'{model._meta.verbose_name} {obj}')
 
         return room_name, users
 
     def rename_by_slug(self, slug, new_name, default_name=None):
-        try:
-            room = self.get(slug=slug)
-
-            if room.name == default_name or default_name is None:
-                room.name = new_name
-                room.save(update_fields=['name'])
+        from whisper.cache import room_cache
+        room = room_cache.get_room(slug)
 
-        except ObjectDoesNotExist:
-            pass
+        if room is not None and (room.name == default_name or default_name is None):
+            room.name = new_name
+            room.save(update_fields=['name'])
 
     def of_user(self, user):
         if not user.is_authenticated:
@@ -96,16 +93,10 @@ class RoomQuerySet(QuerySet):
         if not user.is_authenticated:
             return self.none()
 
-        return self.annotate(
-            unread_messages=
-                Count('message__pk',
-                filter=Q(
-                    Q(message__room__member__user=user, message__created__gt=F('message__room__member__last_read')),
-                    ~Q(message__user=user),
-                    ~Q(message__user=None),
-                )
-            )
-        )
+        from whisper.models import RoomUser
+        unread_count = RoomUser.objects.filter(room=OuterRef('pk'), user=user).values('unread_count')[:1]
+
+        return self.annotate(unread_messages=Coalesce(Subquery(unread_count), 0))
 
     def empty(self):
         return self.filter(message__isnull=True)
@@ -168,6 +159,22 @@ class MessageQuerySet(QuerySet):
     def of_room(self, room):
         return self.filter(room=room)
 
+    def history(self, room, before=None, limit=None):
+        """
+        Keyset paginated history of room, newest first.
+
+        :param before: (created, pk) cursor of the oldest message already loaded
+        :param limit: page size, defaults to WHISPER_HISTORY_PAGE_SIZE
+        """
+        limit = limit or settings.HISTORY_PAGE_SIZE
+        queryset = self.of_room(room)
+
+        if before is not None:
+            created, pk = before
+            queryset = queryset.filter(Q(created__lt=created) | Q(created=created, pk__lt=pk))
+
+        return queryset.order_by('-created', '-pk')[:limit]
+
     def unread_by_user(self, user):
         if not user.is_authenticated:
             return self.none()
@@ -178,3 +185,65 @@ class MessageQuerySet(QuerySet):
                 room__member__user=user,
                 created__gt=F('room__member__last_read')
             )
+
+    def unread_digest(self, user, limit):
+        """
+        Newest unread messages of user, at most `limit` per room, annotated with total number of unread messages in room
+        (filtering by window function requires Django >= 4.2)
+        """
+        return self.unread_by_user(user).annotate(
+            room_rank=Window(RowNumber(), partition_by=F('room_id'), order_by=[F('created').desc(), F('pk').desc()]),
+            room_unread_total=Window(Count('pk'), partition_by=F('room_id')),
+        ).filter(room_rank__lte=limit)
+
+
+class RoomUserQuerySet(QuerySet):
+    def increment_unread(self, room, sender, created, count=1):
+        """
+        Increases unread messages counter of all room members except the sender who haven't read the room
+        since the message was created (members who never read the room have nothing unread)
+        """
+        return self.filter(room=room, last_read__lt=created).exclude(user=sender).update(unread_count=F('unread_count') + count)
+
+    def with_actual_unread_count(self):
+        """
+        Annotates members with unread messages count computed from messages (slow, use for reconciliation only).
+        Members who never read the room (last_read is NULL) have nothing unread.
+        """
+        from whisper.models import Message
+
+        messages = Message.objects \
+            .filter(room=OuterRef('room'), created__gt=OuterRef('last_read')) \
+            .exclude(user=OuterRef('user')) \
+            .exclude(user=None) \
+            .order_by() \
+            .values('room') \
+            .annotate(count=Count('pk')) \
+            .values('count')
+
+        return self.annotate(actual_unread_count=Case(
+            When(last_read=None, then=Value(0)),
+            default=Coalesce(Subquery(messages), 0)
+        ))
+
+    def due_for_notification(self):
+        """
+        Members which should be notified by email about unread messages in room,
+        same conditions as RoomQuerySet.unread_and_not_notified but for all users at once
+        """
+        threshold_date = now() - timedelta(minutes=settings.NOTIFY_ROOM_THRESHOLD)
+
+        query = Q(unread_count__gte=1) & \
+            Q(last_notified__lt=threshold_date) & \
+            Q(last_read__lt=threshold_date) & \
+            Q(last_notified__lt=F('room__modified'))
+
+        user_activity_attribute = settings.USER_ACTIVITY_ATTRIBUTE
+
+        if user_activity_attribute:
+            query &= Q(**{f'user__{user_activity_attribute}__lt': threshold_date})
+
+        return self.filter(query)
+
+    def out_of_sync(self):
+        return self.with_actual_unread_count().exclude(unread_count=F('actual_unread_count'))
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:05
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.timezone import now
+
+
+def compute_unread_counts(apps, schema_editor):
+    Message = apps.get_model('whisper', 'Message')
+    RoomUser = apps.get_model('whisper', 'RoomUser')
+
+    # members who never read the room have nothing unread, new messages are counted from now on
+    RoomUser.objects.filter(last_read=None).update(last_read=now())
+
+    messages = Message.objects \
+        .filter(room=OuterRef('room'), created__gt=OuterRef('last_read')) \
+        .exclude(user=OuterRef('user')) \
+        .exclude(user=None) \
+        .order_by() \
+        .values('room') \
+        .annotate(count=Count('pk')) \
+        .values('count')
+
+    # single set based update instead of query per member
+    RoomUser.objects.update(unread_count=Coalesce(Subquery(messages), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whisper', '0002_message_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roomuser',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='unread messages'),
+        ),
+        migrations.RunPython(compute_unread_counts, migrations.RunPython.noop),
+    ]
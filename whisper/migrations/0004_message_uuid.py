@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:20
+
+import django.utils.timezone
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whisper', '0003_roomuser_unread_count'),
+    ]
+
+    operations = [
+        # existing messages keep empty UUID, unique default can't be applied to them at once
+        migrations.AddField(
+            model_name='message',
+            name='uuid',
+            field=models.UUIDField(editable=False, null=True, unique=True, verbose_name='UUID'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, null=True, unique=True, verbose_name='UUID'),
+        ),
+        # timestamp of queued message is kept when it's stored by write-behind buffer
+        migrations.AlterField(
+            model_name='message',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='created'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whisper', '0004_message_uuid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='rendered_text',
+            field=models.TextField(blank=True, default='', verbose_name='rendered text'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='system_type',
+            field=models.CharField(blank=True, default=None, max_length=50, null=True, verbose_name='system message type'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='system_params',
+            field=models.JSONField(blank=True, default=None, null=True, verbose_name='system message parameters'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:55
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def compute_member_hashes(apps, schema_editor):
+    Room = apps.get_model('whisper', 'Room')
+    RoomUser = apps.get_model('whisper', 'RoomUser')
+    group_hashes = set()
+
+    # newest group room keeps the fingerprint if there are duplicate groups
+    for room in Room.objects.order_by('-created').iterator():
+        user_ids = sorted(set(RoomUser.objects.filter(room=room).values_list('user_id', flat=True)))
+        member_hash = hashlib.sha256(','.join(map(str, user_ids)).encode()).hexdigest()
+
+        if room.slug.startswith('group-'):
+            if member_hash in group_hashes:
+                continue
+
+            group_hashes.add(member_hash)
+
+        Room.objects.filter(pk=room.pk).update(member_hash=member_hash)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whisper', '0005_message_render_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='member_hash',
+            field=models.CharField(blank=True, db_index=True, default=None, editable=False, max_length=64, null=True, verbose_name='member hash'),
+        ),
+        migrations.RunPython(compute_member_hashes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='room',
+            constraint=models.UniqueConstraint(condition=models.Q(('slug__startswith', 'group-')), fields=('member_hash',), name='whisper_unique_group_members'),
+        ),
+    ]
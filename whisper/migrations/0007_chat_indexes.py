@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:45
+
+from django.db import migrations, models
+from django.db.models import Count, F
+
+
+def remove_duplicate_members(apps, schema_editor):
+    RoomUser = apps.get_model('whisper', 'RoomUser')
+
+    duplicates = RoomUser.objects\
+        .values('room_id', 'user_id')\
+        .annotate(members=Count('id'))\
+        .filter(members__gt=1)
+
+    # member with the latest read flag is kept
+    for duplicate in duplicates.iterator():
+        members = RoomUser.objects\
+            .filter(room_id=duplicate['room_id'], user_id=duplicate['user_id'])\
+            .order_by(F('last_read').desc(nulls_last=True), 'id')
+
+        kept = members.first()
+        members.exclude(pk=kept.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whisper', '0006_room_member_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_members, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='roomuser',
+            constraint=models.UniqueConstraint(fields=('room', 'user'), name='whisper_unique_room_user'),
+        ),
+        migrations.AddIndex(
+            model_name='roomuser',
+            index=models.Index(condition=models.Q(('unread_count__gte', 1)), fields=['user', 'last_notified', 'last_read'], name='whisper_roomuser_due_idx'),
+        ),
+    ]
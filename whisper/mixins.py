@@ -1,10 +1,16 @@
-from django.core.exceptions import ObjectDoesNotExist
 from django.utils.functional import cached_property
 
-from whisper.models import Room
+from whisper.cache import room_cache
 
 
 class ChatRoomMixin(object):
+    # prefix of room slug, lowercase model name by default
+    room_slug_prefix = None
+
+    # relations used by room_members, applied when object is fetched for new room
+    room_members_select_related = ()
+    room_members_prefetch_related = ()
+
     @cached_property
     def room_members(self):
         raise NotImplementedError()
@@ -13,9 +19,6 @@ class ChatRoomMixin(object):
     def room_slug(self):
         raise NotImplementedError()
 
-    @property
+    @cached_property
     def room(self):
-        try:
-            return Room.objects.get(slug=self.room_slug)
-        except ObjectDoesNotExist:
-            return None
+        return room_cache.get_room(self.room_slug)
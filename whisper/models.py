@@ -1,12 +1,16 @@
+import hashlib
 import json
+import uuid
+from contextvars import ContextVar
 from json import JSONDecodeError
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.urls import reverse
 from django.utils.timezone import now
+from pragmatic.templatetags.pragmatic_tags import url_anchor
 try:
     # older Django
     from django.utils.translation import ugettext_lazy as _
@@ -14,7 +18,10 @@ except ImportError:
     # Django >= 3
     from django.utils.translation import gettext_lazy as _
 
-from whisper.managers import RoomQuerySet, MessageQuerySet
+from whisper.managers import RoomQuerySet, MessageQuerySet, RoomUserQuerySet
+
+# set while membership of room is changed in bulk, per member signal receivers are skipped
+bulk_membership_change = ContextVar('whisper_bulk_membership_change', default=False)
 
 
 class Room(models.Model):
@@ -23,6 +30,7 @@ class Room(models.Model):
     users = models.ManyToManyField(to=settings.AUTH_USER_MODEL, verbose_name=_('users'), through='RoomUser')
     created = models.DateTimeField(_('created'), auto_now_add=True)
     modified = models.DateTimeField(_('modified'), auto_now=True)
+    member_hash = models.CharField(_('member hash'), max_length=64, blank=True, null=True, default=None, db_index=True, editable=False)
     objects = RoomQuerySet.as_manager()
 
     class Meta:
@@ -30,6 +38,9 @@ class Room(models.Model):
         verbose_name_plural = _('rooms')
         ordering = ('-modified',)
         get_latest_by = 'created'
+        constraints = [
+            models.UniqueConstraint(fields=['member_hash'], condition=models.Q(slug__startswith='group-'), name='whisper_unique_group_members'),
+        ]
 
     def __str__(self):
         return self.name
@@ -42,20 +53,103 @@ class Room(models.Model):
         return f'room_{self.id}'
 
     @property
-    def user_groups(self):
-        user_groups = []
+    def unread_group_name(self):
+        return f'unread-room-{self.id}'
 
-        for member in self.member_set.all():
-            user_groups.append(f'unread-chat-messages-{member.user.pk}')
+    @property
+    def member_ids(self):
+        from whisper.cache import membership_cache
+        return membership_cache.get_member_ids(self.pk)
 
-        return user_groups
+    @property
+    def user_groups(self):
+        from whisper.cache import membership_cache
+        return membership_cache.get_group_names(self.pk)
 
     @property
     def is_user_to_user_room(self):
         return self.slug.startswith('users-')
 
     def add_user(self, user):
-        return RoomUser.objects.get_or_create(room=self, user=user)[0]
+        from whisper.cache import membership_cache
+        room_user, created = RoomUser.objects.get_or_create(room=self, user=user, defaults={'last_read': now()})
+
+        if created:
+            membership_cache.invalidate(self.pk)
+
+        return room_user
+
+    def add_users(self, users, last_read=None):
+        """
+        Adds users to room using single insert, returns list of newly added users.
+        New members have nothing unread, messages are counted since last_read (now by default).
+        """
+        last_read = last_read or now()
+        users = list(users)
+        current_user_ids = set(RoomUser.objects.filter(room=self, user__in=users).values_list('user_id', flat=True))
+        new_users = [user for user in users if user.pk not in current_user_ids]
+
+        RoomUser.objects.bulk_create(
+            [RoomUser(room=self, user=user, last_read=last_read) for user in new_users],
+            ignore_conflicts=True
+        )
+
+        # bulk_create doesn't send post_save signals
+        self.membership_changed([user.pk for user in new_users], 'room_joined')
+
+        return new_users
+
+    def remove_users(self, users):
+        """
+        Removes users from room using single delete, membership change is handled once for all removed users
+        """
+        members = RoomUser.objects.filter(room=self, user__in=users)
+        user_ids = list(members.values_list('user_id', flat=True))
+        token = bulk_membership_change.set(True)
+
+        try:
+            deleted = RoomUser.objects.filter(room=self, user_id__in=user_ids).delete()
+        finally:
+            bulk_membership_change.reset(token)
+
+        self.membership_changed(user_ids, 'room_left')
+
+        return deleted
+
+    @staticmethod
+    def get_member_hash(user_ids):
+        """
+        Canonical fingerprint of set of users
+        """
+        user_ids = sorted(set(map(int, user_ids)))
+        return hashlib.sha256(','.join(map(str, user_ids)).encode()).hexdigest()
+
+    def update_member_hash(self):
+        member_hash = self.get_member_hash(RoomUser.objects.filter(room=self).values_list('user_id', flat=True))
+
+        try:
+            with transaction.atomic():
+                Room.objects.filter(pk=self.pk).update(member_hash=member_hash)
+        except IntegrityError:
+            # another group room has the same members already
+            member_hash = None
+            Room.objects.filter(pk=self.pk).update(member_hash=member_hash)
+
+        self.member_hash = member_hash
+
+    def membership_changed(self, user_ids, event_type):
+        from whisper.cache import membership_cache, recent_rooms_cache
+        from whisper.helpers import ChatMessageHelper
+
+        if not user_ids:
+            return
+
+        membership_cache.invalidate(self.pk)
+        recent_rooms_cache.invalidate(user_ids)
+        self.update_member_hash()
+
+        for user_id in user_ids:
+            ChatMessageHelper.send_membership_event(self.pk, user_id, event_type)
 
 
 class RoomUser(models.Model):
@@ -63,6 +157,16 @@ class RoomUser(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_query_name='member', related_name='member_set')
     last_read = models.DateTimeField(_('last read'), blank=True, null=True, default=None)
     last_notified = models.DateTimeField(_('last notified'), default=now)
+    unread_count = models.PositiveIntegerField(_('unread messages'), default=0)
+    objects = RoomUserQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='whisper_unique_room_user'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'last_notified', 'last_read'], condition=models.Q(unread_count__gte=1), name='whisper_roomuser_due_idx'),
+        ]
 
     @staticmethod
     def get_possible_users_to_add(room_pk):
@@ -81,10 +185,15 @@ class RoomUser(models.Model):
 
 
 class Message(models.Model):
+    uuid = models.UUIDField(_('UUID'), default=uuid.uuid4, editable=False, unique=True, null=True)
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, blank=True, null=True, default=None)
     text = models.TextField(_('text'))
-    created = models.DateTimeField(_('created'), auto_now_add=True)
+    rendered_text = models.TextField(_('rendered text'), blank=True, default='')
+    system_type = models.CharField(_('system message type'), max_length=50, blank=True, null=True, default=None)
+    system_params = models.JSONField(_('system message parameters'), blank=True, null=True, default=None)
+    # not auto_now_add, timestamp of queued message (already broadcast) is kept when it's stored by bulk_create
+    created = models.DateTimeField(_('created'), default=now, editable=False)
     modified = models.DateTimeField(_('modified'), auto_now=True)
     objects = MessageQuerySet.as_manager()
 
@@ -92,21 +201,93 @@ class Message(models.Model):
         verbose_name = _('message')
         verbose_name_plural = _('messages')
         ordering = ('created',)
+        indexes = [
+            models.Index(fields=['room', 'created', 'id'], name='whisper_message_history_idx'),
+        ]
 
     def __str__(self):
-        if self.user is not None:
+        if self.user_id is not None:
             # non-system message
             return self.text
 
         # system message
         from whisper.helpers import ChatMessageHelper
-        try:
-            message = json.loads(self.text)
-            message_key = next(iter(message))
-            params = message.get(message_key)
-            return ChatMessageHelper.message_from_type(message_key, **params)
-        except JSONDecodeError:
+
+        if self.system_type is not None:
+            return ChatMessageHelper.message_from_type(self.system_type, **(self.system_params or {}))
+
+        system_message = self.parse_system_message(self.text)
+
+        if system_message is None:
             return str(self.text)
 
+        message_type, params = system_message
+        return ChatMessageHelper.message_from_type(message_type, **(params or {}))
+
+    @staticmethod
+    def parse_system_message(text):
+        """
+        Returns (type, parameters) of system message or None if text isn't one (e.g. other JSON like lists or strings)
+        """
+        try:
+            message = json.loads(text)
+        except (JSONDecodeError, TypeError):
+            return None
+
+        if not isinstance(message, dict) or not message:
+            return None
+
+        message_type = next(iter(message))
+        params = message.get(message_type)
+
+        if params is not None and not isinstance(params, dict):
+            return None
+
+        return message_type, params
+
     def get_absolute_url(self):
         return self.room.get_absolute_url()
+
+    RENDER_FIELDS = ['rendered_text', 'system_type', 'system_params']
+
+    def save(self, *args, **kwargs):
+        self.prepare_render_fields()
+
+        # render fields are derived from text, they are saved together with it
+        if kwargs.get('update_fields', None) is not None:
+            kwargs['update_fields'] = self.get_update_fields(kwargs['update_fields'])
+
+        super().save(*args, **kwargs)
+
+    def get_update_fields(self, update_fields):
+        if update_fields is None or 'text' not in update_fields:
+            return update_fields
+
+        return list(update_fields) + [field for field in self.RENDER_FIELDS if field not in update_fields]
+
+    def prepare_render_fields(self):
+        """
+        Precomputes linkified text of user messages and parses type and parameters of system messages
+        """
+        self.rendered_text = ''
+        self.system_type = None
+        self.system_params = None
+
+        if self.user_id is None:
+            system_message = self.parse_system_message(self.text)
+
+            if system_message is not None:
+                self.system_type, self.system_params = system_message
+                return
+
+        self.rendered_text = url_anchor(self.text)
+
+    def get_rendered_text(self):
+        if self.system_type is not None:
+            return str(self)
+
+        if self.rendered_text:
+            return self.rendered_text
+
+        # messages created before render fields were introduced
+        return url_anchor(str(self))
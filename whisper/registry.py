@@ -0,0 +1,45 @@
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+
+
+class ChatRoomRegistry:
+    """
+    Models with chat rooms (implementing ChatRoomMixin) by their room slug prefix
+    """
+    def __init__(self):
+        self.models = {}
+        self.prefixes = {}
+
+    def register(self, model, prefix=None):
+        prefix = prefix or getattr(model, 'room_slug_prefix', None) or model.__name__.lower()
+        registered_model = self.models.get(prefix, None)
+
+        if registered_model is not None and registered_model is not model:
+            raise ImproperlyConfigured(f'Room slug prefix "{prefix}" is already registered for {registered_model.__name__}')
+
+        self.models[prefix] = model
+        self.prefixes[model] = prefix
+
+    def autodiscover(self):
+        from whisper.mixins import ChatRoomMixin
+
+        for model in apps.get_models():
+            if issubclass(model, ChatRoomMixin) and model not in self.prefixes:
+                self.register(model)
+
+    def get_model(self, prefix):
+        return self.models.get(prefix, None)
+
+    def get_prefix(self, model):
+        return self.prefixes.get(model, model.__name__.lower())
+
+    def get_object(self, prefix, pk):
+        model = self.models[prefix]
+
+        return model._default_manager \
+            .select_related(*getattr(model, 'room_members_select_related', ())) \
+            .prefetch_related(*getattr(model, 'room_members_prefetch_related', ())) \
+            .get(pk=pk)
+
+
+registry = ChatRoomRegistry()
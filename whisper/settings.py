@@ -19,6 +19,7 @@ ROOM_FORM_CLASS = getattr(
     settings, 'WHISPER_ROOM_FORM_CLASS', None
 )
 
+# chat socket renders the form with room_pk keyword argument (and autocomplete for RoomAddMemberForm subclasses)
 ROOM_ADD_MEMBER_FORM_CLASS = getattr(
     settings, 'WHISPER_ROOM_ADD_MEMBER_FORM_CLASS', 'whisper.forms.RoomAddMemberForm'
 )
@@ -32,7 +33,19 @@ USER_INFO = getattr(
 )
 
 CHAT_USERS = getattr(
-    settings, 'WHISPER_CHAT_USERS', lambda: get_user_model().all()
+    settings, 'WHISPER_CHAT_USERS', lambda: get_user_model().objects.all()  # callable returning QuerySet (or other iterable) of users searched by user directory
+)
+
+USER_SEARCH_FIELD = getattr(
+    settings, 'WHISPER_USER_SEARCH_FIELD', None  # indexed field used for prefix search, USERNAME_FIELD by default
+)
+
+USER_DIRECTORY_PAGE_SIZE = getattr(
+    settings, 'WHISPER_USER_DIRECTORY_PAGE_SIZE', 30  # users
+)
+
+USER_ENTRY_CACHE_TIMEOUT = getattr(
+    settings, 'WHISPER_USER_ENTRY_CACHE_TIMEOUT', 60 * 60  # seconds
 )
 
 RECENT_ROOM_THRESHOLD = getattr(
@@ -43,15 +56,121 @@ NOTIFY_ROOM_THRESHOLD = getattr(
     settings, 'WHISPER_NOTIFY_ROOM_THRESHOLD', 30  # minutes
 )
 
+HISTORY_PAGE_SIZE = getattr(
+    settings, 'WHISPER_HISTORY_PAGE_SIZE', 50  # messages
+)
+
+MESSAGE_FLUSH_INTERVAL = getattr(
+    settings, 'WHISPER_MESSAGE_FLUSH_INTERVAL', 0.1  # seconds
+)
+
+DURABLE_MESSAGES = getattr(
+    settings, 'WHISPER_DURABLE_MESSAGES', False  # wait until message is stored before broadcasting it
+)
+
+UNREAD_SEQUENCE_CACHE = getattr(
+    settings, 'WHISPER_UNREAD_SEQUENCE_CACHE', 'default'  # cache alias shared by all processes, sequences are disabled for process local caches
+)
+
+UNREAD_PENDING_TIMEOUT = getattr(
+    settings, 'WHISPER_UNREAD_PENDING_TIMEOUT', 5 * 60  # seconds, expiration of unread events of messages not stored yet
+)
+
+ROOM_ACTIVITY_FLUSH_INTERVAL = getattr(
+    settings, 'WHISPER_ROOM_ACTIVITY_FLUSH_INTERVAL', 1  # seconds
+)
+
+MEMBERSHIP_CACHE_TIMEOUT = getattr(
+    settings, 'WHISPER_MEMBERSHIP_CACHE_TIMEOUT', 60 * 60  # seconds
+)
+
+ROOM_CACHE_TIMEOUT = getattr(
+    settings, 'WHISPER_ROOM_CACHE_TIMEOUT', 60 * 60  # seconds
+)
+
+ROOM_NEGATIVE_CACHE_TIMEOUT = getattr(
+    settings, 'WHISPER_ROOM_NEGATIVE_CACHE_TIMEOUT', 60  # seconds, for slugs without room
+)
+
+RECENT_ROOMS_CACHE_TIMEOUT = getattr(
+    settings, 'WHISPER_RECENT_ROOMS_CACHE_TIMEOUT', 5 * 60  # seconds
+)
+
+LOCAL_CACHE_SIZE = getattr(
+    settings, 'WHISPER_LOCAL_CACHE_SIZE', 1000  # entries per process
+)
+
+LOCAL_CACHE_TIMEOUT = getattr(
+    settings, 'WHISPER_LOCAL_CACHE_TIMEOUT', 5  # seconds, upper bound of staleness after change in other process
+)
+
+TYPING_THROTTLE = getattr(
+    settings, 'WHISPER_TYPING_THROTTLE', 2  # seconds between typing events of one user
+)
+
+TYPING_TIMEOUT = getattr(
+    settings, 'WHISPER_TYPING_TIMEOUT', 5  # seconds after user is not considered typing without new event
+)
+
+TYPING_BROADCAST_INTERVAL = getattr(
+    settings, 'WHISPER_TYPING_BROADCAST_INTERVAL', 1  # seconds
+)
+
+NOTIFY_CHUNK_SIZE = getattr(
+    settings, 'WHISPER_NOTIFY_CHUNK_SIZE', 500  # room members fetched at once
+)
+
+NOTIFY_USERS_PER_JOB = getattr(
+    settings, 'WHISPER_NOTIFY_USERS_PER_JOB', 100
+)
+
+NOTIFY_QUEUE = getattr(
+    settings, 'WHISPER_NOTIFY_QUEUE', 'default'  # RQ queue of notification jobs
+)
+
+NOTIFY_MESSAGES_PER_ROOM = getattr(
+    settings, 'WHISPER_NOTIFY_MESSAGES_PER_ROOM', 10  # newest unread messages listed in notification
+)
+
+NOTIFY_EMAIL_BACKEND = getattr(
+    settings, 'WHISPER_NOTIFY_EMAIL_BACKEND', None  # EMAIL_BACKEND by default, locmem or file backend can be used for benchmarks
+)
+
+NOTIFY_EMAIL_BATCH_SIZE = getattr(
+    settings, 'WHISPER_NOTIFY_EMAIL_BATCH_SIZE', 50  # messages sent over one connection at once
+)
+
+NOTIFY_RATE_LIMIT = getattr(
+    settings, 'WHISPER_NOTIFY_RATE_LIMIT', None  # emails per second, unlimited by default
+)
+
+NOTIFY_LOCK_TIMEOUT = getattr(
+    settings, 'WHISPER_NOTIFY_LOCK_TIMEOUT', 5 * 60  # seconds
+)
+
+INSTRUMENTATION = getattr(
+    settings, 'WHISPER_INSTRUMENTATION', False  # measure consumer events (duration, DB queries, channel layer sends, frames)
+)
+
+INSTRUMENTATION_CALLBACK = getattr(
+    settings, 'WHISPER_INSTRUMENTATION_CALLBACK', None  # dotted path of callable receiving every measurement
+)
+
 DATETIME_FORMAT = getattr(
     settings, 'WHISPER_DATETIME_FORMAT', 'd.m.Y H:i:s'
 )
 
-MESSAGE_TYPES = getattr(
-    settings, 'WHISPER_MESSAGE_TYPES',
-    {
-        'USER_LEFT': _('{username} left room'),
-        'USER_JOINED': _('{username} joined room'),
-        'USER_TYPING': ugettext('{username} is typing ...'),
-    }
-)
+DEFAULT_MESSAGE_TYPES = {
+    'USER_LEFT': _('{username} left room'),
+    'USER_JOINED': _('{username} joined room'),
+    'USERS_LEFT': _('{usernames} left room'),
+    'USERS_JOINED': _('{usernames} joined room'),
+    'USER_TYPING': ugettext('{username} is typing ...'),
+    'USERS_TYPING': ugettext('{usernames} are typing ...'),
+}
+
+# types missing in project setting fall back to defaults
+MESSAGE_TYPES = {
+    **DEFAULT_MESSAGE_TYPES,
+    **getattr(settings, 'WHISPER_MESSAGE_TYPES', {})
+}
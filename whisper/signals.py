@@ -0,0 +1,42 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from whisper.cache import room_cache
+from whisper.models import Room, RoomUser, bulk_membership_change
+
+
+@receiver(pre_save, sender=Room)
+def room_slug_changing(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or (update_fields is not None and 'slug' not in update_fields):
+        return
+
+    old_slug = Room.objects.filter(pk=instance.pk).values_list('slug', flat=True).first()
+
+    if old_slug is not None and old_slug != instance.slug:
+        room_cache.invalidate(old_slug)
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance, **kwargs):
+    # clears cached missing room on create and stale data on rename
+    room_cache.invalidate(instance.slug)
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    room_cache.invalidate(instance.slug)
+
+
+@receiver(post_save, sender=RoomUser)
+def room_user_saved(sender, instance, created, **kwargs):
+    # updates of read/notified flags don't change membership
+    if created and not bulk_membership_change.get():
+        instance.room.membership_changed([instance.user_id], 'room_joined')
+
+
+@receiver(post_delete, sender=RoomUser)
+def room_user_deleted(sender, instance, **kwargs):
+    if bulk_membership_change.get():
+        return
+
+    instance.room.membership_changed([instance.user_id], 'room_left')
@@ -12,10 +12,20 @@ function initSocket(room_slug, scrollItem) {
     var member_list_wrapper = chat_room_members.find('.member-list-wrapper');
     var member_form = chat_room_members.find('.form-wrapper');
     var chat_room_members_footer = $('.chat-room-members footer');
+    var member_search = chat_room_members_footer.find('.member-search');
+    var member_candidates = chat_room_members_footer.find('.member-candidates');
+    var member_candidates_next = null;
+    var member_candidates_loading = false;
+    var member_search_timeout = null;
     var user_typing = chat_room.find('#user-typing');
     var current_username = messages_wrapper.data('current-username');
     var room_action = chat_room.find('.room-action');
     var room_id = null;
+    var oldest_message = null;
+    var has_older_messages = false;
+    var loading_older_messages = false;
+    var history_scroll_item = scrollItem == null ? chat_room.find('.message-list-wrapper') : scrollItem;
+    var history_scroll_target = scrollItem == null ? history_scroll_item : $(window);
 
     var chat_url = '/ws/chat/' + room_slug + '/';
     var ws_protocol = window.location.protocol == 'https:' ? 'wss://' : 'ws://';
@@ -35,6 +45,12 @@ function initSocket(room_slug, scrollItem) {
             handleRoomMembers(data);
         } else if (type == 'new_room') {
             handleNewRoom(data);
+        } else if (type == 'history') {
+            handleHistory(data);
+        } else if (type == 'member_candidates') {
+            handleMemberCandidates(data);
+        } else if (type == 'message_failed') {
+            handleMessageFailed(data);
         } else {
             handleMessage(data, type);
         }
@@ -43,6 +59,9 @@ function initSocket(room_slug, scrollItem) {
     socket.onopen = function (e) {
         console.log('Chat socket opened at ' + socket_endpoint);
         messages_wrapper.html('');
+        oldest_message = null;
+        has_older_messages = false;
+        loading_older_messages = false;
     };
 
     socket.onclose = function (e) {
@@ -50,6 +69,11 @@ function initSocket(room_slug, scrollItem) {
         //alert('Chat error, try to reload the page');
     };
 
+    function handleMessageFailed(data) {
+        console.error('Chat message ' + data['uuid'] + ' was not sent');
+        alert(gettext('Message was not sent, try it again'));
+    }
+
     function handleRoomProperties(data) {
         room_id = data['room_id'];
         chat_room_header.html(data['room_name']);
@@ -93,16 +117,14 @@ function initSocket(room_slug, scrollItem) {
     }
 
     function handleUserTyping(data) {
-        var username = data['username'];
-        if (current_username != username) {
+        // merged list of other users typing in the room, empty list means nobody is typing
+        user_typing.stop(true);
+
+        if (data['usernames'].length) {
             user_typing.html(data['text']);
-            if (!user_typing.is(":visible")) {
-                user_typing.animate({opacity: 1}, 500);
-            } else {
-                user_typing.stop(true);
-                user_typing.animate({opacity: 1}, 0);
-            }
-            user_typing.animate({opacity: 0}, 3000);
+            user_typing.animate({opacity: 1}, 500);
+        } else {
+            user_typing.animate({opacity: 0}, 500);
         }
     }
 
@@ -112,7 +134,7 @@ function initSocket(room_slug, scrollItem) {
 
         var members = data['members'];
         members.forEach(function (member) {
-            member_list_wrapper.append(member['html']);
+            member_list_wrapper.append(memberHtml(member));
         });
         member_form.append(data['form']);
 
@@ -121,7 +143,59 @@ function initSocket(room_slug, scrollItem) {
         $(window).trigger(event);
     }
 
-    function handleMessage(data, type) {
+    function memberSelect() {
+        // options of autocomplete select are added by picked candidates
+        var member_select = member_form.find('select[data-autocomplete="users"]');
+        return member_select.length ? member_select : member_form.find('select');
+    }
+
+    function memberHtml(member) {
+        if (member['html']) {
+            return member['html'];
+        }
+
+        var item = $('<div class="chat-item position-relative"></div>').text(member['name']);
+
+        if (member['removable']) {
+            item.append($('<a class="remove-member" href="#"><i class="fas fa-times"></i></a>')
+                .attr('data-user-name', member['name'])
+                .attr('data-user-id', member['id']));
+        }
+
+        return item;
+    }
+
+    function handleMemberCandidates(data) {
+        if (data['query'] != member_search.val().trim()) {
+            // response to outdated query
+            return;
+        }
+
+        var candidates = data['users'].map(function (user) {
+            return $('<a href="#" class="member-candidate d-block"></a>').attr('data-user-id', user['id']).text(user['name']);
+        });
+
+        if (!data['append']) {
+            member_candidates.html('');
+        }
+
+        member_candidates.append(candidates);
+        member_candidates_next = data['next'];
+        member_candidates_loading = false;
+    }
+
+    function searchMembers(after) {
+        if (socket.readyState === socket.OPEN) {
+            member_candidates_loading = true;
+            socket.send(JSON.stringify({
+                'type': 'search_members',
+                'query': member_search.val().trim(),
+                'after': after
+            }));
+        }
+    }
+
+    function messageHtml(data) {
         var message = data['message'];
         var username = data['username'];
         var timestamp = data['timestamp'];
@@ -133,11 +207,53 @@ function initSocket(room_slug, scrollItem) {
             username = 'System';
         }
 
-        messages_wrapper.append('<div class="' + message_class + '"><span>' + message + '</span><small>' + username + ', ' + timestamp + '</small></div>');
+        return '<div class="' + message_class + '"><span>' + message + '</span><small>' + username + ', ' + timestamp + '</small></div>';
+    }
 
+    function handleMessage(data, type) {
+        messages_wrapper.append(messageHtml(data));
         scrollDownChat(type == 'chat_message', scrollItem);
     }
 
+    function handleHistory(data) {
+        var messages = data['messages'];
+
+        has_older_messages = data['has_more'];
+        loading_older_messages = false;
+
+        if (messages.length === 0) {
+            return;
+        }
+
+        oldest_message = {'created': messages[0]['created'], 'id': messages[0]['id']};
+
+        var history_html = messages.map(messageHtml).join('');
+
+        if (data['older']) {
+            // keep current scroll position while prepending older messages
+            var scroll_height = messages_wrapper.prop('scrollHeight');
+            messages_wrapper.prepend(history_html);
+            history_scroll_item.scrollTop(history_scroll_item.scrollTop() + messages_wrapper.prop('scrollHeight') - scroll_height);
+        } else {
+            messages_wrapper.append(history_html);
+            scrollDownChat(false, scrollItem);
+        }
+    }
+
+    function loadOlderMessages() {
+        if (!has_older_messages || loading_older_messages || oldest_message == null) {
+            return;
+        }
+
+        if (socket.readyState === socket.OPEN) {
+            loading_older_messages = true;
+            socket.send(JSON.stringify({
+                'type': 'load_older',
+                'before': oldest_message
+            }));
+        }
+    }
+
     function sendMessage() {
         var message = message_input.val().trim();
 
@@ -153,10 +269,11 @@ function initSocket(room_slug, scrollItem) {
         }
     }
 
-    function sendUserTyping() {
+    function sendUserTyping(typing) {
         if (socket.readyState === socket.OPEN) {
             socket.send(JSON.stringify({
-                'type': 'user_typing'
+                'type': 'user_typing',
+                'typing': typing
             }));
         }
     }
@@ -174,10 +291,15 @@ function initSocket(room_slug, scrollItem) {
         if (e.keyCode === 13 && !e.shiftKey) {  // enter, return, without shift
             sendMessage();
         } else {
-            sendUserTyping();
+            sendUserTyping(message_input.val().trim().length > 0);
         }
     });
 
+    message_input.unbind('blur');
+    message_input.on('blur', function (e) {
+        sendUserTyping(false);
+    });
+
     message_submit.unbind('click');
     message_submit.on('click', function (e) {
         sendMessage();
@@ -189,6 +311,13 @@ function initSocket(room_slug, scrollItem) {
         hideChatRoom(socket);
     });
 
+    history_scroll_target.unbind('scroll.history');
+    history_scroll_target.on('scroll.history', function (e) {
+        if (history_scroll_item.scrollTop() < 50) {
+            loadOlderMessages();
+        }
+    });
+
     room_action.unbind('click');
     room_action.click(function (e) {
         var url = $(this).data('url');
@@ -210,7 +339,7 @@ function initSocket(room_slug, scrollItem) {
 
     chat_room_members_footer.unbind('click');
     chat_room_members_footer.on('click', 'button', function (event) {
-        var member_select = member_form.find('select');
+        var member_select = memberSelect();
 
         if (Array.isArray(member_select.val()) && member_select.val().length) {
             if (socket.readyState === socket.OPEN) {
@@ -218,7 +347,15 @@ function initSocket(room_slug, scrollItem) {
                     'type': 'add_members',
                     'user_ids': member_select.val()
                 }));
-                member_select.val('')
+                if (member_select.data('autocomplete')) {
+                    member_select.find('option').remove();
+                } else {
+                    member_select.val('');
+                }
+
+                member_select.trigger('change');
+                member_search.val('');
+                member_candidates.html('');
             } else {
                 alert('Chat error, try to reload the page');
             }
@@ -227,6 +364,37 @@ function initSocket(room_slug, scrollItem) {
         event.preventDefault();
     });
 
+    chat_room_members_footer.on('click', '.member-candidate', function (event) {
+        // only picked users are rendered as options of member select
+        var member_select = memberSelect();
+        var user_id = String($(this).data('user-id'));
+
+        if (!member_select.find('option[value="' + user_id + '"]').length) {
+            member_select.append($('<option></option>').val(user_id).text($(this).text()));
+        }
+
+        member_select.find('option[value="' + user_id + '"]').prop('selected', true);
+        member_select.trigger('change');
+        $(this).remove();
+
+        event.preventDefault();
+    });
+
+    member_search.off('input');
+    member_search.on('input', function (e) {
+        clearTimeout(member_search_timeout);
+        member_search_timeout = setTimeout(function () {
+            searchMembers(null);
+        }, 300);
+    });
+
+    member_candidates.off('scroll');
+    member_candidates.on('scroll', function (e) {
+        if (member_candidates_next && !member_candidates_loading && this.scrollTop + this.clientHeight > this.scrollHeight - 50) {
+            searchMembers(member_candidates_next);
+        }
+    });
+
 
     return socket;
 }
@@ -298,9 +466,20 @@ function initUnreadChatMessagesSocket() {
 
     var socket_endpoint = ws_protocol + window.location.host + socket_url;
     var socket = new ReconnectingWebSocket(socket_endpoint, null, {reconnectInterval: 3000});
+    var user_search = $('#pills-users .chat-user-search');
+    var user_list = $('#pills-users .chat-user-list');
+    var user_list_next = null;
+    var user_list_loading = false;
+    var user_search_timeout = null;
 
     socket.onmessage = function (e) {
         var data = JSON.parse(e.data);
+
+        if (data['type'] == 'users') {
+            handleUsers(data);
+            return;
+        }
+
         var unread_messages = data['unread_messages'];
         var unread_rooms = data['unread_rooms'];
 
@@ -328,6 +507,7 @@ function initUnreadChatMessagesSocket() {
 
     socket.onopen = function (e) {
         console.log('Unread chat messages socket opened at ' + socket_endpoint);
+        searchUsers(null);
     };
 
     socket.onclose = function (e) {
@@ -335,6 +515,56 @@ function initUnreadChatMessagesSocket() {
         //alert('Chat error, try to reload the page');
     };
 
+    function handleUsers(data) {
+        if (data['query'] != user_search.val().trim()) {
+            // response to outdated query
+            return;
+        }
+
+        var users_html = data['users'].map(function (user) {
+            return '<div class="chat-item position-relative">' + user['html'] +
+                '<a class="chat-room-show position-absolute d-block h-100 w-100" href="#" data-room-slug="' + user['room_slug'] + '"></a></div>';
+        }).join('');
+
+        if (data['append']) {
+            user_list.append(users_html);
+        } else {
+            user_list.html(users_html);
+        }
+
+        user_list_next = data['next'];
+        user_list_loading = false;
+    }
+
+    function searchUsers(after) {
+        if (socket.readyState === WebSocket.OPEN) {
+            user_list_loading = true;
+            socket.send(JSON.stringify({
+                'type': 'search_users',
+                'query': user_search.val().trim(),
+                'after': after
+            }));
+        }
+    }
+
+    user_search.on('input', function (e) {
+        clearTimeout(user_search_timeout);
+        user_search_timeout = setTimeout(function () {
+            searchUsers(null);
+        }, 300);
+    });
+
+    // users tab doesn't scroll itself, its tab content does (scroll events don't bubble)
+    $('#chat-tabContent').on('scroll', function (e) {
+        if (!$('#pills-users').hasClass('active')) {
+            return;
+        }
+
+        if (user_list_next && !user_list_loading && this.scrollTop + this.clientHeight > this.scrollHeight - 100) {
+            searchUsers(user_list_next);
+        }
+    });
+
     return socket;
 }
 
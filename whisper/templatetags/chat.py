@@ -1,6 +1,8 @@
 from django import template
 from django.contrib.auth import get_user_model
 
+from whisper.registry import registry
+
 register = template.Library()
 
 
@@ -17,5 +19,5 @@ def room_slug(context, subject):
         users_pks = list(map(str, users_pks))
         return 'users-{}'.format('-'.join(users_pks))
 
-    model_name = subject.__class__.__name__.lower()
+    model_name = registry.get_prefix(subject.__class__)
     return f'{model_name}-{subject.pk}'
@@ -0,0 +1,33 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from whisper import settings
+from whisper.directory import user_directory
+
+
+class UserDirectoryTest(TestCase):
+    """
+    Users of WHISPER_CHAT_USERS are searched by prefix of search field and paginated by keyset cursor
+    """
+    @classmethod
+    def setUpTestData(cls):
+        user_model = get_user_model()
+        cls.users = [user_model.objects.create(**{user_model.USERNAME_FIELD: f'directory-{index}'}) for index in range(3)]
+
+    @mock.patch.object(settings, 'USER_DIRECTORY_PAGE_SIZE', 2)
+    def test_pages(self):
+        users, after = user_directory.search(user_directory.get_users(), 'directory-')
+        self.assertEqual(users, self.users[:2])
+
+        users, after = user_directory.search(user_directory.get_users(), 'directory-', after)
+        self.assertEqual(users, self.users[2:])
+        self.assertIsNone(after)
+
+    def test_list_of_users(self):
+        # other iterables than QuerySet are supported as well
+        with mock.patch.object(settings, 'CHAT_USERS', lambda: self.users[1:]):
+            users, after = user_directory.search(user_directory.get_users(), 'directory-')
+
+        self.assertEqual(users, self.users[1:])
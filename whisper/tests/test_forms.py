@@ -0,0 +1,44 @@
+from unittest import mock
+
+from django import forms
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from whisper import settings
+from whisper.consumers import ChatConsumer
+from whisper.models import Room
+
+
+class CustomAddMemberForm(forms.Form):
+    """
+    Custom add member form which doesn't know autocomplete keyword argument
+    """
+    users = forms.CharField()
+
+    def __init__(self, *args, **kwargs):
+        self.room_pk = kwargs.pop('room_pk')
+        super().__init__(*args, **kwargs)
+
+
+class RoomMembersFormTest(TestCase):
+    """
+    Add member form of chat socket uses autocomplete widget only with RoomAddMemberForm
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(**{get_user_model().USERNAME_FIELD: 'form-test'})
+        cls.room = Room.objects.create_group()
+        cls.room.add_users([cls.user])
+
+    async def get_form(self):
+        consumer = ChatConsumer()
+        consumer.room = self.room
+        consumer.user = self.user
+        return (await consumer.get_room_members())['form']
+
+    async def test_autocomplete(self):
+        self.assertIn('data-autocomplete="users"', await self.get_form())
+
+    @mock.patch.object(settings, 'ROOM_ADD_MEMBER_FORM_CLASS', f'{__name__}.CustomAddMemberForm')
+    async def test_custom_form(self):
+        self.assertIn('name="users"', await self.get_form())
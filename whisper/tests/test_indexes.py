@@ -0,0 +1,66 @@
+from unittest import skipUnless
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+
+from whisper.cache import recent_rooms_cache
+from whisper.cron import get_due_members, get_due_user_ids
+from whisper.models import Message, Room, RoomUser
+
+
+@skipUnless(connection.vendor == 'sqlite', 'query plans are checked on SQLite')
+class HotQueryIndexTest(TestCase):
+    """
+    Hot chat queries (as they are run by cache and cron) use indexes of migration 0007 (and message history index)
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(**{get_user_model().USERNAME_FIELD: 'index-test'})
+        cls.room = Room.objects.create_group()
+        cls.room.add_users([cls.user])
+
+    def get_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return '\n'.join(row[-1] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, *index_names):
+        plan = self.get_plan(queryset)
+        self.assertTrue(any(index_name in plan for index_name in index_names), f'{index_names} not used by:\n{plan}')
+
+    def assertNotScanned(self, queryset):
+        plan = self.get_plan(queryset)
+        self.assertFalse(any(row.startswith('SCAN') for row in plan.splitlines()), f'table scanned by:\n{plan}')
+
+    def test_due_user_ids(self):
+        # planner scans only members with unread messages (partial index) in order of users
+        self.assertUsesIndex(get_due_user_ids(), 'whisper_roomuser_due_idx')
+        self.assertNotIn('TEMP B-TREE', self.get_plan(get_due_user_ids()))
+
+    def test_due_members(self):
+        self.assertUsesIndex(get_due_members([self.user.pk]), 'whisper_roomuser_due_idx')
+        self.assertNotScanned(get_due_members([self.user.pk]))
+
+    def test_unread_and_not_notified(self):
+        # memberships of single user are found by user index (due index is partial)
+        self.assertUsesIndex(Room.objects.unread_and_not_notified(self.user), 'whisper_roomuser_user_id')
+        self.assertNotScanned(Room.objects.unread_and_not_notified(self.user))
+
+    def test_message_history(self):
+        self.assertUsesIndex(Message.objects.history(self.room), 'whisper_message_history_idx')
+
+    def test_recent_rooms(self):
+        # rooms are found by memberships of user, only rooms of user are sorted by modified
+        queryset = recent_rooms_cache.get_queryset(self.user)
+        self.assertUsesIndex(queryset, 'whisper_roomuser_user_id')
+        self.assertNotScanned(queryset)
+
+    def test_room_user_lookup(self):
+        # unique constraint is created as table constraint (autoindex) by SQLite
+        self.assertUsesIndex(
+            RoomUser.objects.filter(room=self.room, user=self.user),
+            'whisper_unique_room_user', 'sqlite_autoindex_whisper_roomuser'
+        )
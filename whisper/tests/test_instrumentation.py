@@ -0,0 +1,187 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.http import Http404
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase, override_settings
+
+from whisper import settings
+from whisper.instrumentation import MetricsAggregator, event_measured, measure, record_query, record_send
+from whisper.models import Room
+from whisper.routing import websocket_urlpatterns
+from whisper.views import MetricsView
+from whisper.writers import room_activity
+
+
+def create_measurement(event, duration, consumer='ChatConsumer', source='client', **counts):
+    return SimpleNamespace(labels=(consumer, source, event), duration=duration, **{
+        attribute: counts.get(attribute, 0) for attribute, name, description in MetricsAggregator.COUNTERS
+    })
+
+
+@mock.patch.object(settings, 'INSTRUMENTATION', True)
+class MeasureTest(SimpleTestCase):
+    """
+    Nested measurements are counted by outer measurements as well
+    """
+    def test_nested(self):
+        with measure('outer') as outer:
+            record_send()
+
+            with measure('inner') as inner:
+                record_send(2)
+
+        self.assertEqual(inner.sends, 2)
+        self.assertEqual(outer.sends, 3)
+        self.assertTrue(outer.finished)
+        self.assertEqual(outer.as_dict()['sends'], 3)
+
+    def test_outlived(self):
+        # sends after measured event finished (e.g. by background task) are not counted
+        with measure('event') as measurement:
+            pass
+
+        record_send()
+        self.assertEqual(measurement.sends, 0)
+
+    def test_emitted(self):
+        measurements = []
+        receiver = lambda sender, measurement, **kwargs: measurements.append(measurement)
+        event_measured.connect(receiver)
+        self.addCleanup(event_measured.disconnect, receiver)
+
+        with measure('outer'):
+            with measure('inner'):
+                pass
+
+        self.assertEqual([measurement.event for measurement in measurements], ['inner', 'outer'])
+
+    def test_disabled(self):
+        with mock.patch.object(settings, 'INSTRUMENTATION', False), measure('event') as measurement:
+            self.assertIsNone(measurement)
+
+
+class MetricsAggregatorTest(SimpleTestCase):
+    """
+    Totals of measurements exported in Prometheus text format
+    """
+    def setUp(self):
+        self.aggregator = MetricsAggregator()
+
+    def test_totals(self):
+        self.aggregator.record(create_measurement('chat_message', 0.02, queries=3, sends=2))
+        self.aggregator.record(create_measurement('chat_message', 0.5, consumer='UnreadChatMessagesConsumer', source='group', frames=1))
+
+        self.assertEqual(self.aggregator.get_totals('chat_message')['count'], 2)
+        self.assertEqual(self.aggregator.get_totals('chat_message', consumer='ChatConsumer')['queries'], 3)
+        self.assertEqual(self.aggregator.get_totals('chat_message', source='group')['frames'], 1)
+        self.assertEqual(self.aggregator.get_totals('connect'), {})
+
+    def test_cumulative_buckets(self):
+        self.aggregator.record(create_measurement('chat_message', 0.02))
+        self.aggregator.record(create_measurement('chat_message', 0.3))
+        lines = self.aggregator.export().splitlines()
+        labels = 'consumer="ChatConsumer",source="client",event="chat_message"'
+
+        self.assertIn(f'whisper_event_duration_seconds_bucket{{{labels},le="0.01"}} 0', lines)
+        self.assertIn(f'whisper_event_duration_seconds_bucket{{{labels},le="0.025"}} 1', lines)
+        self.assertIn(f'whisper_event_duration_seconds_bucket{{{labels},le="0.5"}} 2', lines)
+        self.assertIn(f'whisper_event_duration_seconds_bucket{{{labels},le="+Inf"}} 2', lines)
+        self.assertIn(f'whisper_event_duration_seconds_count{{{labels}}} 2', lines)
+        self.assertIn('# TYPE whisper_event_duration_seconds histogram', lines)
+        self.assertIn('# TYPE whisper_event_queries_total counter', lines)
+
+    def test_label_escaping(self):
+        self.aggregator.record(create_measurement('chat_message', 0.1, consumer='My"Consumer\\\n'))
+        self.assertIn('consumer="My\\"Consumer\\\\\\n"', self.aggregator.export())
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+@mock.patch.object(settings, 'INSTRUMENTATION', True)
+class ConsumerMeasurementTest(TransactionTestCase):
+    """
+    Consumer events are measured with their DB queries, channel layer sends and sent frames
+    """
+    def setUp(self):
+        self.user = get_user_model().objects.create(**{get_user_model().USERNAME_FIELD: 'measured'})
+        self.room = Room.objects.create_group()
+        self.room.add_users([self.user])
+
+        self.measurements = []
+        receiver = lambda sender, measurement, **kwargs: self.measurements.append(measurement)
+        event_measured.connect(receiver)
+        self.addCleanup(event_measured.disconnect, receiver)
+
+        # queries of consumers run by this thread's connection
+        connection.execute_wrappers.append(record_query)
+        self.addCleanup(connection.execute_wrappers.remove, record_query)
+
+    def get_measurement(self, event):
+        return next(measurement for measurement in self.measurements if measurement.event == event)
+
+    async def test_round_trip(self):
+        with mock.patch.object(room_activity, 'touch'):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.room.slug}/')
+            communicator.scope['user'] = self.user
+            connected, code = await communicator.connect()
+            self.assertTrue(connected)
+
+            # room properties and history
+            await communicator.receive_json_from()
+            await communicator.receive_json_from()
+
+            await communicator.send_json_to({'type': 'room_members'})
+            await communicator.receive_json_from()
+
+            await communicator.send_json_to({'type': 'user_typing'})
+            await communicator.disconnect()
+
+        connect = self.get_measurement('connect')
+        self.assertEqual((connect.consumer, connect.source), ('ChatConsumer', 'websocket'))
+        self.assertGreater(connect.queries, 0)
+        self.assertEqual(connect.frames, 2)
+
+        room_members = self.get_measurement('room_members')
+        self.assertEqual(room_members.source, 'client')
+        self.assertGreater(room_members.queries, 0)
+        self.assertEqual(room_members.frames, 1)
+        self.assertGreater(room_members.frame_bytes, 0)
+        self.assertEqual(room_members.sends, 0)
+
+        user_typing = self.get_measurement('user_typing')
+        self.assertEqual((user_typing.sends, user_typing.queries, user_typing.frames), (1, 0, 0))
+
+        # typing stopped
+        self.assertEqual(self.get_measurement('disconnect').sends, 1)
+
+
+@mock.patch.object(settings, 'INSTRUMENTATION', True)
+class MetricsViewTest(SimpleTestCase):
+    """
+    Metrics are available only to staff users and INTERNAL_IPS
+    """
+    def get(self, user, remote_addr='10.0.0.1'):
+        request = RequestFactory().get('/metrics/', REMOTE_ADDR=remote_addr)
+        request.user = user
+        return MetricsView.as_view()(request)
+
+    def test_staff(self):
+        response = self.get(SimpleNamespace(is_staff=True))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+    @override_settings(INTERNAL_IPS=['10.0.0.1'])
+    def test_internal_ip(self):
+        self.assertEqual(self.get(AnonymousUser()).status_code, 200)
+
+    def test_denied(self):
+        with self.assertRaises(Http404):
+            self.get(AnonymousUser())
+
+    def test_disabled(self):
+        with mock.patch.object(settings, 'INSTRUMENTATION', False), self.assertRaises(Http404):
+            self.get(SimpleNamespace(is_staff=True))
@@ -0,0 +1,68 @@
+import importlib
+
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from whisper import settings
+from whisper.helpers import ChatMessageHelper
+from whisper.models import Message, Room
+
+
+class MessageRenderFieldsTest(SimpleTestCase):
+    """
+    Render fields of system messages are set only for JSON objects, other texts are rendered as they are
+    """
+    def create_message(self, text):
+        message = Message(text=text)
+        message.prepare_render_fields()
+        return message
+
+    def test_system_message(self):
+        message = self.create_message('{"USER_LEFT": {"username": "john"}}')
+        self.assertEqual(message.system_type, 'USER_LEFT')
+        self.assertEqual(message.system_params, {'username': 'john'})
+        self.assertEqual(str(message), 'john left room')
+
+    def test_other_json(self):
+        for text in ['[1, 2]', '"abc"', '{}', '1', '{"USER_LEFT": 1}']:
+            with self.subTest(text=text):
+                message = self.create_message(text)
+                self.assertIsNone(message.system_type)
+                self.assertIsNone(message.system_params)
+                self.assertEqual(str(message), text)
+
+    def test_plain_text(self):
+        message = self.create_message('abc')
+        self.assertIsNone(message.system_type)
+        self.assertEqual(str(message), 'abc')
+
+    def test_without_render_fields(self):
+        # messages created before render fields were introduced
+        self.assertEqual(str(Message(text='{"USER_JOINED": {"username": "john"}}')), 'john joined room')
+        self.assertEqual(str(Message(text='[1, 2]')), '[1, 2]')
+
+
+class MessageSaveTest(TestCase):
+    """
+    Render fields are saved together with text
+    """
+    def test_update_fields(self):
+        room = Room.objects.create_group()
+        message = Message.objects.create(room=room, text='abc')
+        message.text = 'https://example.com'
+        message.save(update_fields=['text'])
+
+        message.refresh_from_db()
+        self.assertIn('href', message.rendered_text)
+
+
+class MessageTypesTest(SimpleTestCase):
+    """
+    Message types missing in WHISPER_MESSAGE_TYPES fall back to defaults
+    """
+    def test_project_types(self):
+        with override_settings(WHISPER_MESSAGE_TYPES={'USER_LEFT': '{username} is gone'}):
+            importlib.reload(settings)
+
+        self.addCleanup(importlib.reload, settings)
+        self.assertEqual(ChatMessageHelper.message_from_type('USER_LEFT', username='john'), 'john is gone')
+        self.assertEqual(ChatMessageHelper.message_from_type('USERS_JOINED', usernames='john, jane'), 'john, jane joined room')
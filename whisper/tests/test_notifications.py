@@ -0,0 +1,106 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend
+from django.template import engines
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+
+from whisper import settings
+from whisper.cron import notify_about_unread_messages, notify_users
+from whisper.models import Room, RoomUser
+
+
+class FailingEmailBackend(EmailBackend):
+    """
+    Locmem backend failing to send all messages after the first batch
+    """
+    def send_messages(self, messages):
+        if mail.outbox:
+            raise ConnectionError('SMTP server is gone')
+
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+@mock.patch.object(settings, 'NOTIFY_EMAIL_BATCH_SIZE', 1)
+@mock.patch('whisper.cron.get_notification_templates', lambda: (engines['django'].from_string('{{ recipient }}'), None))  # notification.txt uses tags of project
+class NotificationTest(TestCase):
+    """
+    Notifications are planned in chunks, progress is checkpointed per batch, so failed jobs can be retried
+    without sending the same notifications twice
+    """
+    @classmethod
+    def setUpTestData(cls):
+        user_model = get_user_model()
+        cls.sender = user_model.objects.create(**{user_model.USERNAME_FIELD: 'notify-sender'})
+        cls.users = [
+            user_model.objects.create(**{user_model.USERNAME_FIELD: f'notify-{index}', 'email': f'notify-{index}@example.com'})
+            for index in range(3)
+        ]
+        cls.room = Room.objects.create_group()
+        cls.room.add_users([cls.sender, *cls.users])
+
+        # members read the room long ago and have unread messages
+        RoomUser.objects.filter(user__in=cls.users).update(
+            last_read=now() - timedelta(hours=1),
+            last_notified=now() - timedelta(hours=2),
+            unread_count=1
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def get_user_ids(self):
+        return [user.pk for user in self.users]
+
+    def get_notified(self):
+        return sorted(message.to[0] for message in mail.outbox)
+
+    def is_due(self, user):
+        return RoomUser.objects.due_for_notification().filter(user=user).exists()
+
+    @mock.patch.object(settings, 'NOTIFY_USERS_PER_JOB', 2)
+    def test_planner_chunks(self):
+        with mock.patch('whisper.cron.enqueue_notifications') as enqueue_notifications:
+            self.assertEqual(notify_about_unread_messages(), 2)
+
+        user_ids = self.get_user_ids()
+        self.assertEqual([call.args[0] for call in enqueue_notifications.call_args_list], [user_ids[:2], user_ids[2:]])
+
+    def test_checkpoint(self):
+        self.assertEqual(notify_users(self.get_user_ids()), 3)
+        self.assertEqual(self.get_notified(), [user.email for user in self.users])
+        self.assertFalse(any(self.is_due(user) for user in self.users))
+
+        # notified users are not due anymore
+        self.assertEqual(notify_users(self.get_user_ids()), 0)
+        self.assertEqual(len(mail.outbox), 3)
+
+    @mock.patch.object(settings, 'NOTIFY_EMAIL_BACKEND', f'{__name__}.FailingEmailBackend')
+    def test_resume_after_failure(self):
+        with self.assertRaises(ConnectionError):
+            notify_users(self.get_user_ids())
+
+        # first batch is checkpointed, locks of failed batch are released
+        self.assertEqual(self.get_notified(), [self.users[0].email])
+        self.assertFalse(self.is_due(self.users[0]))
+        self.assertTrue(self.is_due(self.users[1]))
+        self.assertIsNone(cache.get(f'whisper:notify:{self.users[1].pk}'))
+
+        # retried job sends only notifications which weren't sent
+        with mock.patch.object(settings, 'NOTIFY_EMAIL_BACKEND', None):
+            self.assertEqual(notify_users(self.get_user_ids()), 2)
+
+        self.assertEqual(self.get_notified(), [user.email for user in self.users])
+
+    def test_duplicate_chunk(self):
+        # user is being notified by another worker
+        cache.add(f'whisper:notify:{self.users[0].pk}', True)
+
+        self.assertEqual(notify_users(self.get_user_ids()), 2)
+        self.assertEqual(self.get_notified(), [user.email for user in self.users[1:]])
+        self.assertTrue(self.is_due(self.users[0]))
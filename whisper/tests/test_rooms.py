@@ -0,0 +1,43 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from whisper.managers import RoomQuerySet
+from whisper.models import Room, RoomUser
+
+
+class GroupRoomMembersTest(TestCase):
+    """
+    Group rooms are found by fingerprint of their members, which is unique among group rooms
+    """
+    @classmethod
+    def setUpTestData(cls):
+        user_model = get_user_model()
+        cls.users = [user_model.objects.create(**{user_model.USERNAME_FIELD: f'group-{index}'}) for index in range(2)]
+        cls.user_ids = [user.pk for user in cls.users]
+
+    def test_existing_group(self):
+        room = Room.objects.get_or_create_from_users(self.user_ids)
+        self.assertEqual(Room.objects.get_or_create_from_users(reversed(self.user_ids)), room)
+        self.assertEqual(set(RoomUser.objects.filter(room=room).values_list('user_id', flat=True)), set(self.user_ids))
+
+    def test_created_meanwhile(self):
+        room = Room.objects.get_or_create_from_users(self.user_ids)
+
+        # another process creates the same group after lookup
+        with mock.patch.object(RoomQuerySet, 'first', return_value=None):
+            self.assertEqual(Room.objects.get_or_create_from_users(self.user_ids), room)
+
+        self.assertEqual(Room.objects.filter(slug__startswith='group-').count(), 1)
+
+    def test_membership_collision(self):
+        room = Room.objects.get_or_create_from_users(self.user_ids)
+        other_room = Room.objects.get_or_create_from_users(self.user_ids[:1])
+
+        # other room has the same members now, room with the same fingerprint exists already
+        other_room.add_users(self.users[1:])
+        other_room.refresh_from_db()
+
+        self.assertIsNone(other_room.member_hash)
+        self.assertEqual(Room.objects.get_or_create_from_users(self.user_ids), room)
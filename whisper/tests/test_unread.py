@@ -0,0 +1,143 @@
+import shutil
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from whisper.consumers import UnreadChatMessagesConsumer
+from whisper.helpers import ChatMessageHelper
+from whisper.models import Message, Room, RoomUser
+
+
+class UnreadSequenceTest(TestCase):
+    """
+    Per room sequences of unread events and messages which are not stored yet
+    """
+    @classmethod
+    def setUpTestData(cls):
+        user_model = get_user_model()
+        cls.sender = user_model.objects.create(**{user_model.USERNAME_FIELD: 'sequence-sender'})
+        cls.reader = user_model.objects.create(**{user_model.USERNAME_FIELD: 'sequence-reader'})
+        cls.room = Room.objects.create_group()
+        cls.room.add_users([cls.sender, cls.reader])
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        # file based cache is shared by processes
+        shared_cache = override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory}})
+        shared_cache.enable()
+        self.addCleanup(shared_cache.disable)
+
+    def get_pending(self, user):
+        return ChatMessageHelper.count_pending_unread(ChatMessageHelper.get_unread_sequences([self.room.pk]), user.pk)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_local_cache(self):
+        self.assertIsNone(ChatMessageHelper.next_unread_sequence(self.room))
+        self.assertEqual(ChatMessageHelper.get_unread_sequences([self.room.pk]), {})
+
+    def test_sequence(self):
+        self.assertEqual(ChatMessageHelper.next_unread_sequence(self.room), 1)
+        self.assertEqual(ChatMessageHelper.next_unread_sequence(self.room), 2)
+        self.assertEqual(ChatMessageHelper.get_unread_sequences([self.room.pk]), {self.room.pk: 2})
+
+    def test_pending(self):
+        first = ChatMessageHelper.next_unread_sequence(self.room, pending_sender=self.sender)
+        ChatMessageHelper.next_unread_sequence(self.room, pending_sender=self.sender)
+
+        # sender doesn't count own messages
+        self.assertEqual(self.get_pending(self.reader), {self.room.pk: 2})
+        self.assertEqual(self.get_pending(self.sender), {})
+
+        ChatMessageHelper.discard_pending_unread([(self.room.pk, first)])
+        self.assertEqual(self.get_pending(self.reader), {self.room.pk: 1})
+
+    def test_stored_out_of_order(self):
+        # writers of other processes store messages out of order, earlier events stay pending
+        first = ChatMessageHelper.next_unread_sequence(self.room, pending_sender=self.sender)
+        second = ChatMessageHelper.next_unread_sequence(self.room, pending_sender=self.sender)
+        ChatMessageHelper.discard_pending_unread([(self.room.pk, second)])
+        self.assertEqual(self.get_pending(self.reader), {self.room.pk: 1})
+
+        ChatMessageHelper.discard_pending_unread([(self.room.pk, first)])
+        self.assertEqual(self.get_pending(self.reader), {})
+
+
+class UnreadCounterTest(TestCase):
+    """
+    Incrementally maintained unread counters agree with counts computed from messages
+    """
+    @classmethod
+    def setUpTestData(cls):
+        user_model = get_user_model()
+        cls.sender = user_model.objects.create(**{user_model.USERNAME_FIELD: 'counter-sender'})
+        cls.member = user_model.objects.create(**{user_model.USERNAME_FIELD: 'counter-member'})
+        cls.room = Room.objects.create_group()
+        cls.room.add_users([cls.sender])
+        Message.objects.create(room=cls.room, user=cls.sender, text='before')
+
+    def send(self, text):
+        message = Message.objects.create(room=self.room, user=self.sender, text=text)
+        RoomUser.objects.increment_unread(self.room, self.sender, message.created)
+
+    def get_member(self):
+        return RoomUser.objects.get(room=self.room, user=self.member)
+
+    def test_added_member(self):
+        # history before joining is not unread
+        self.room.add_users([self.member])
+        self.assertEqual(self.get_member().unread_count, 0)
+        self.assertFalse(RoomUser.objects.out_of_sync().exists())
+
+        self.send('after')
+        self.assertEqual(self.get_member().unread_count, 1)
+        self.assertFalse(RoomUser.objects.out_of_sync().exists())
+
+    def test_added_single_member(self):
+        self.room.add_user(self.member)
+        self.send('after')
+        self.assertEqual(self.get_member().unread_count, 1)
+        self.assertFalse(RoomUser.objects.out_of_sync().exists())
+
+    def test_never_read(self):
+        # member who never read the room has nothing unread
+        RoomUser.objects.create(room=self.room, user=self.member, last_read=None)
+        self.send('after')
+        self.assertEqual(self.get_member().unread_count, 0)
+        self.assertFalse(RoomUser.objects.out_of_sync().exists())
+        self.assertFalse(Message.objects.unread_by_user(self.member).exists())
+
+
+class UnreadEventOrderTest(SimpleTestCase):
+    """
+    Out of order unread events are counted once, resync is needed only when events are lost
+    """
+    def setUp(self):
+        self.consumer = UnreadChatMessagesConsumer()
+        self.consumer.sequences = {1: 4}
+        self.consumer.missing_sequences = {}
+
+    def check(self, *sequences):
+        return [self.consumer.check_sequence(1, sequence) for sequence in sequences]
+
+    def test_in_order(self):
+        self.assertEqual(self.check(5, 6), [True, True])
+
+    def test_reordered(self):
+        self.assertEqual(self.check(6, 5), [True, True])
+        self.assertEqual(self.consumer.missing_sequences[1], set())
+
+    def test_counted_by_resync(self):
+        # resync read sequence 4, events up to it are counted already
+        self.assertEqual(self.check(3, 4, 5, 5), [False, False, True, False])
+
+    def test_lost(self):
+        window = UnreadChatMessagesConsumer.REORDER_WINDOW
+        self.assertEqual(self.check(*range(6, 5 + window)), [True] * (window - 1))
+        self.assertIsNone(self.consumer.check_sequence(1, 5 + window))
+
+    def test_reset(self):
+        self.consumer.sequences = {1: 100}
+        self.assertIsNone(self.consumer.check_sequence(1, 1))
@@ -0,0 +1,231 @@
+import asyncio
+from datetime import timedelta
+from unittest import mock
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils.timezone import now
+
+from whisper import settings
+from whisper.cache import recent_rooms_cache
+from whisper.models import Message, Room, RoomUser
+from whisper.routing import websocket_urlpatterns
+from whisper.writers import MessageWriter, RoomActivityTracker, message_writer, room_activity
+
+
+def create_user(username):
+    return get_user_model().objects.create(**{get_user_model().USERNAME_FIELD: username})
+
+
+def create_message(room, user, text):
+    message = Message(room=room, user=user, text=text)
+    message.prepare_render_fields()
+    return message
+
+
+@mock.patch.object(room_activity, 'touch')
+class MessageWriterFlushTest(TestCase):
+    """
+    Failed batch is stored room by room and then message by message, so only invalid messages are lost
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('writer-test')
+        cls.room = Room.objects.create_group()
+        cls.other_room = Room.objects.create_group()
+        cls.room.add_users([cls.user])
+        cls.other_room.add_users([cls.user])
+
+    def create_duplicate(self, room):
+        # stored message with the same uuid makes insert fail
+        stored = create_message(room, self.user, 'stored')
+        stored.save()
+        duplicate = create_message(room, self.user, 'duplicate')
+        duplicate.uuid = stored.uuid
+        return duplicate
+
+    def test_batch(self, touch):
+        messages = [create_message(self.room, self.user, 'one'), create_message(self.other_room, self.user, 'two')]
+
+        with mock.patch.object(MessageWriter, 'flush', wraps=MessageWriter.flush) as flush:
+            errors = MessageWriter.flush_batch(messages)
+
+        self.assertEqual(errors, {})
+        self.assertEqual(flush.call_count, 1)
+        self.assertEqual(Message.objects.filter(text__in=['one', 'two']).count(), 2)
+
+    def test_read_before_flush(self, touch):
+        # member read the room after message was queued, before it was stored
+        reader = create_user('writer-reader')
+        self.room.add_users([reader])
+        message = create_message(self.room, self.user, 'seen')
+        message.created = now()
+        RoomUser.objects.filter(room=self.room, user=reader).update(last_read=now(), unread_count=0)
+
+        MessageWriter.flush([message])
+
+        self.assertEqual(RoomUser.objects.get(room=self.room, user=reader).unread_count, 0)
+        self.assertFalse(RoomUser.objects.out_of_sync().exists())
+
+    def test_failure_isolation(self, touch):
+        good = create_message(self.room, self.user, 'good')
+        bad = self.create_duplicate(self.room)
+        other = create_message(self.other_room, self.user, 'other')
+
+        with mock.patch.object(MessageWriter, 'flush', wraps=MessageWriter.flush) as flush, self.assertLogs('whisper.writers', 'ERROR'):
+            errors = MessageWriter.flush_batch([good, bad, other])
+
+        # batch, room with invalid message, its messages one by one, other room
+        self.assertEqual([len(call.args[0]) for call in flush.call_args_list], [3, 2, 1, 1, 1])
+        self.assertEqual(list(errors.keys()), [bad.uuid])
+        self.assertTrue(Message.objects.filter(uuid=good.uuid, text='good').exists())
+        self.assertTrue(Message.objects.filter(uuid=other.uuid, text='other').exists())
+        self.assertFalse(Message.objects.filter(text='duplicate').exists())
+
+    def test_failed_room(self, touch):
+        bad = self.create_duplicate(self.room)
+        other = create_message(self.other_room, self.user, 'other')
+
+        with mock.patch.object(MessageWriter, 'flush', wraps=MessageWriter.flush) as flush, self.assertLogs('whisper.writers', 'ERROR'):
+            errors = MessageWriter.flush_batch([bad, other])
+
+        # single message of room is not retried
+        self.assertEqual([len(call.args[0]) for call in flush.call_args_list], [2, 1, 1])
+        self.assertEqual(list(errors.keys()), [bad.uuid])
+        self.assertTrue(Message.objects.filter(uuid=other.uuid).exists())
+
+
+class RoomActivityTrackerTest(TestCase):
+    """
+    Latest activity of rooms is written back to Room.modified, never moving it back
+    """
+    def setUp(self):
+        self.room = Room.objects.create_group()
+        self.tracker = RoomActivityTracker()
+        self.addCleanup(self.tracker.flush)
+
+    def get_modified(self):
+        return Room.objects.values_list('modified', flat=True).get(pk=self.room.pk)
+
+    def test_flush(self):
+        modified = self.room.modified + timedelta(minutes=1)
+        self.tracker.touch(self.room.pk, modified - timedelta(seconds=1))
+        self.tracker.touch(self.room.pk, modified)
+        self.tracker.flush()
+
+        self.assertEqual(self.get_modified(), modified)
+        self.assertEqual(self.tracker.pending, {})
+        self.assertIsNone(self.tracker.timer)
+
+    def test_flush_invalidates_recent_rooms(self):
+        self.tracker.touch(self.room.pk, self.room.modified + timedelta(minutes=1))
+
+        with mock.patch.object(recent_rooms_cache, 'invalidate_room') as invalidate_room, self.captureOnCommitCallbacks(execute=True):
+            self.tracker.flush()
+
+        invalidate_room.assert_called_once_with(self.room.pk)
+
+    def test_flush_cancels_timer(self):
+        self.tracker.touch(self.room.pk, self.room.modified + timedelta(minutes=1))
+        timer = self.tracker.timer
+        self.tracker.flush()
+
+        # timer would wait for WHISPER_ROOM_ACTIVITY_FLUSH_INTERVAL otherwise
+        timer.join(0.1)
+        self.assertFalse(timer.is_alive())
+
+    def test_older_activity(self):
+        self.tracker.touch(self.room.pk, self.room.modified - timedelta(minutes=1))
+        self.tracker.flush()
+        self.assertEqual(self.get_modified(), self.room.modified)
+
+    def test_update(self):
+        # written immediately by short-lived processes
+        modified = self.room.modified + timedelta(minutes=1)
+        RoomActivityTracker.update(self.room.pk, modified)
+        self.assertEqual(self.get_modified(), modified)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+@mock.patch.object(settings, 'MESSAGE_FLUSH_INTERVAL', 0.01)
+@mock.patch.object(settings, 'DURABLE_MESSAGES', True)
+class DurableMessageTest(TransactionTestCase):
+    """
+    Messages are broadcasted after they are stored, sender is notified about messages which are not
+    """
+    def setUp(self):
+        self.user = create_user('durable-test')
+        self.room = Room.objects.create_group()
+        self.room.add_users([self.user])
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.room.slug}/')
+        communicator.scope['user'] = self.user
+        connected, code = await communicator.connect()
+        self.assertTrue(connected)
+
+        # room properties and history
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+        return communicator
+
+    async def stop_writer(self, communicator):
+        await communicator.disconnect()
+        message_writer.task.cancel()
+
+        try:
+            await message_writer.task
+        except asyncio.CancelledError:
+            pass
+
+    async def test_stored(self):
+        with mock.patch.object(room_activity, 'touch'):
+            communicator = await self.connect()
+            await communicator.send_json_to({'message': 'durable'})
+            frame = await communicator.receive_json_from()
+            await self.stop_writer(communicator)
+
+        self.assertEqual(frame['type'], 'chat_message')
+        self.assertTrue(await Message.objects.filter(uuid=frame['uuid'], text='durable').aexists())
+
+    async def test_failed(self):
+        with mock.patch.object(MessageWriter, 'flush', side_effect=RuntimeError('database is gone')), self.assertLogs('whisper.writers', 'ERROR'):
+            communicator = await self.connect()
+            await communicator.send_json_to({'message': 'lost'})
+            frame = await communicator.receive_json_from()
+
+            # socket is still open
+            await communicator.send_json_to({'type': 'load_older', 'before': 'invalid'})
+            self.assertTrue(await communicator.receive_nothing())
+            await self.stop_writer(communicator)
+
+        self.assertEqual(frame['type'], 'message_failed')
+        self.assertFalse(await Message.objects.filter(uuid=frame['uuid']).aexists())
+
+    async def test_discard_error(self):
+        # messages are stored even if pending unread events can't be discarded (e.g. cache is down)
+        with mock.patch('whisper.writers.ChatMessageHelper.discard_pending_unread', side_effect=RuntimeError('cache is gone')), \
+                mock.patch.object(room_activity, 'touch'), self.assertLogs('whisper.writers', 'ERROR'):
+            communicator = await self.connect()
+            await communicator.send_json_to({'message': 'stored'})
+            frame = await communicator.receive_json_from()
+
+            # writer is still running
+            self.assertFalse(message_writer.task.done())
+            await self.stop_writer(communicator)
+
+        self.assertEqual(frame['type'], 'chat_message')
+        self.assertTrue(await Message.objects.filter(uuid=frame['uuid'], text='stored').aexists())
+
+    async def test_store_error(self):
+        # unexpected error of writer doesn't leave sender waiting
+        with mock.patch.object(MessageWriter, 'store_batch', side_effect=RuntimeError('database is gone')), self.assertLogs('whisper.writers', 'ERROR'):
+            communicator = await self.connect()
+            await communicator.send_json_to({'message': 'unknown'})
+            frame = await communicator.receive_json_from()
+            self.assertFalse(message_writer.task.done())
+            await self.stop_writer(communicator)
+
+        self.assertEqual(frame['type'], 'message_failed')
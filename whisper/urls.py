@@ -1,7 +1,7 @@
 from django.urls import path
 from django.utils.translation import pgettext_lazy
 
-from whisper.views import RoomView, RoomUpdateView, RoomLeaveView, RoomAddMemberView, RoomListView
+from whisper.views import RoomView, RoomUpdateView, RoomLeaveView, RoomAddMemberView, RoomListView, MetricsView
 
 app_name = 'whisper'
 
@@ -11,4 +11,5 @@ urlpatterns = [
     path(pgettext_lazy('url', 'room/<slug>/add-member/'), RoomAddMemberView.as_view(), name='room_add_member'),
     path(pgettext_lazy('url', 'room/<slug>/'), RoomView.as_view(), name='room_detail'),
     path(pgettext_lazy('url', 'room/'), RoomListView.as_view(), name='room_list'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
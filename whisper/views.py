@@ -1,8 +1,11 @@
 from whisper import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.conf import settings as django_settings
+from django.http import Http404, HttpResponse
 from django.shortcuts import redirect
 from django.utils.module_loading import import_string
-from django.views.generic import DetailView, UpdateView, ListView
+from django.views.generic import DetailView, UpdateView, ListView, View
+from whisper.instrumentation import aggregator
 from whisper.models import Room, RoomUser
 
 
@@ -61,3 +64,17 @@ class RoomAddMemberView(LoginRequiredMixin, UpdateView):
 
     def get_form_class(self):
         return self.load_form_class()
+
+
+class MetricsView(View):
+    """
+    Consumer metrics in Prometheus text format, available to staff users and INTERNAL_IPS
+    """
+    def get(self, request, *args, **kwargs):
+        if not settings.INSTRUMENTATION:
+            raise Http404
+
+        if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in django_settings.INTERNAL_IPS:
+            raise Http404
+
+        return HttpResponse(aggregator.export(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,211 @@
+import asyncio
+import atexit
+import logging
+import threading
+from collections import Counter
+from functools import partial
+
+from channels.db import database_sync_to_async
+from django.db import transaction, connection
+from django.utils.timezone import now
+
+from whisper import settings
+from whisper.cache import recent_rooms_cache
+from whisper.helpers import ChatMessageHelper
+from whisper.models import Message, Room, RoomUser
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+    Per process write-behind buffer of chat messages.
+
+    Messages are queued by consumers and stored in batches using bulk_create
+    every WHISPER_MESSAGE_FLUSH_INTERVAL seconds, so no ORM work runs on the event loop.
+    """
+    def __init__(self):
+        self.loop = None
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+
+        if self.loop is not loop or self.task is None or self.task.done():
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            self.task = loop.create_task(self.run())
+
+    def write(self, room, user, text, sequence=None):
+        """
+        Queues new message, returns unsaved message instance and future resolved when message is stored
+        (only with WHISPER_DURABLE_MESSAGES, None otherwise)
+
+        :param sequence: unread sequence of message, its event is pending until message is stored
+        """
+        self.start()
+        message = Message(room=room, user=user, text=text, created=now())
+        message.prepare_render_fields()
+        stored = self.loop.create_future() if settings.DURABLE_MESSAGES else None
+        self.queue.put_nowait((message, sequence, stored))
+        return message, stored
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(settings.MESSAGE_FLUSH_INTERVAL)
+                await self.store(self.get_batch())
+        except asyncio.CancelledError:
+            # worker is stopping, store messages still waiting in queue
+            await self.store(self.get_batch())
+            raise
+
+    def get_batch(self):
+        batch = []
+
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+
+        return batch
+
+    async def store(self, batch):
+        if not batch:
+            return
+
+        try:
+            errors = await database_sync_to_async(self.store_batch)(batch)
+        except Exception as e:
+            # writer keeps running, senders waiting for stored messages are told they failed
+            logger.exception('Failed to store batch of chat messages')
+            errors = {message.uuid: e for message, sequence, stored in batch}
+
+        for message, sequence, stored in batch:
+            if stored is not None and not stored.done():
+                if message.uuid in errors:
+                    stored.set_exception(errors[message.uuid])
+                else:
+                    stored.set_result(message)
+
+    def store_batch(self, batch):
+        try:
+            return self.flush_batch([message for message, sequence, stored in batch])
+        finally:
+            # stored (or lost) messages are counted by unread counters (or never will be)
+            try:
+                ChatMessageHelper.discard_pending_unread([(message.room_id, sequence) for message, sequence, stored in batch])
+            except Exception:
+                # messages are stored already, pending events expire after WHISPER_UNREAD_PENDING_TIMEOUT
+                logger.exception('Failed to discard pending unread events')
+
+    @classmethod
+    def flush_batch(cls, messages):
+        """
+        Stores messages at once. If it fails (e.g. room or user was deleted meanwhile), messages are stored
+        room by room and then one by one, so only invalid messages are lost. Returns errors by message UUID.
+        """
+        try:
+            cls.flush(messages)
+            return {}
+        except Exception as e:
+            if len(messages) == 1:
+                logger.exception('Failed to store chat message %s', messages[0].uuid)
+                return {messages[0].uuid: e}
+
+        rooms = {}
+
+        for message in messages:
+            rooms.setdefault(message.room_id, []).append(message)
+
+        chunks = rooms.values() if len(rooms) > 1 else [[message] for message in messages]
+        errors = {}
+
+        for chunk in chunks:
+            errors.update(cls.flush_batch(chunk))
+
+        return errors
+
+    @staticmethod
+    @transaction.atomic
+    def flush(messages):
+        Message.objects.bulk_create(messages)
+
+        # unread counters of room members, members who read the room since message was sent (and queued) have seen it
+        for (room_id, user_id, created), count in Counter((message.room_id, message.user_id, message.created) for message in messages).items():
+            RoomUser.objects.increment_unread(room_id, user_id, created, count)
+
+        # update modified timestamp
+        for message in messages:
+            room_activity.touch(message.room_id, message.created)
+
+        # requests in the meantime would cache recent rooms without new messages
+        for room_id in {message.room_id for message in messages}:
+            transaction.on_commit(partial(recent_rooms_cache.invalidate_room, room_id))
+
+
+class RoomActivityTracker:
+    """
+    Per process record of latest activity in rooms.
+
+    Instead of saving the whole room on every message, latest activity time is kept in memory
+    and written back to Room.modified at most once per room every WHISPER_ROOM_ACTIVITY_FLUSH_INTERVAL seconds.
+    Pending activity is written when process exits as well.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timer = None
+        atexit.register(self.flush_at_exit)
+
+    def touch(self, room_pk, modified=None):
+        modified = modified or now()
+
+        with self.lock:
+            self.pending[room_pk] = max(modified, self.pending.get(room_pk, modified))
+
+            if self.timer is None:
+                self.timer = threading.Timer(settings.ROOM_ACTIVITY_FLUSH_INTERVAL, self.flush_in_thread)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush_in_thread(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Failed to update rooms activity')
+        finally:
+            connection.close()
+
+    def flush_at_exit(self):
+        if self.pending:
+            self.flush_in_thread()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        if not pending:
+            return
+
+        with transaction.atomic():
+            for room_pk, modified in pending.items():
+                self.update(room_pk, modified)
+
+                # recent rooms cached before flush have old ordering and may miss the room
+                transaction.on_commit(partial(recent_rooms_cache.invalidate_room, room_pk))
+
+    @staticmethod
+    def update(room_pk, modified):
+        """
+        Writes activity of room immediately (used by short-lived processes which can't wait for flush)
+        """
+        # never move modified timestamp back (other processes could be ahead)
+        Room.objects.filter(pk=room_pk, modified__lt=modified).update(modified=modified)
+
+
+message_writer = MessageWriter()
+room_activity = RoomActivityTracker()